@@ -1,21 +1,92 @@
 # coding: utf-8
 
+import bisect
+import collections
+import heapq
+import itertools
+import math
+import mmap
+import operator
+import struct
+import sys
 import tempfile
+import threading
+import time
 import pickle
-import os
 
-def my_bisect_insert(a, x, cmp=cmp):
-    lo, hi = 0, len(a)
-    while lo < hi:
-        mid = (lo + hi) // 2
-        if cmp(x, a[mid]) < 0: hi = mid
-        else: lo = mid + 1
-    a.insert(lo, x)
+def sizeof(obj, seen=None):
+    '''
+    Approximate bytes held by obj: sys.getsizeof of it and everything it
+    refers to.  Objects with __getstate__ count the state they pickle, so
+    lookup tables shared between objects are left out.
+
+    >>> sizeof([]) < sizeof(['abc']) < sizeof(['abc', 'abc' * 10])
+    True
+    '''
+    if seen is None: seen = set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if obj is None or isinstance(obj, (basestring, int, long, float)):
+        return size
+    if isinstance(obj, dict):
+        children = obj.keys() + obj.values()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    elif hasattr(obj, '__getstate__'):
+        children = [obj.__getstate__()]
+    elif hasattr(obj, '__dict__'):
+        children = [obj.__dict__]
+    else:
+        children = [getattr(obj, name) for name in getattr(obj.__class__, '__slots__', ()) if hasattr(obj, name)]
+    return size + sum(sizeof(child, seen) for child in children)
+
+class Descending(object):
+    '''
+    Reverses the order of a value so that heapq pops the largest first.
+    Only used when BigHeap is given no key.
+    '''
+    __slots__ = ['value']
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
 
 class BigHeap(object):
     '''
     Basic protocol.  You can only do append(item) and pop().
 
+    Items on memory are kept in a binary heap of (priority, -seq, item)
+    tuples.  key(item) gives a number and the largest key is popped first;
+    the priority is its negation, so comparisons stay on ints.  Without key
+    the items themselves are compared.  Among equal keys the latest appended
+    item is popped first.  Items beyond max_threshold are stored as sorted
+    (key, seq, item) tuples in DistributedItems.
+
+    With codec, spilled items are stored as fixed-size records instead of
+    pickles.  A codec offers size, encode(item) returning size bytes and
+    decode(data, offset), and needs a key giving ints.
+
+    With prefetch=True the fragment to be loaded next is read and decoded
+    by a background thread, so a refill only merges decoded items.  With
+    measure=True the latency of each pop is recorded for
+    latency_percentiles().
+
+    With max_bytes the thresholds follow a memory budget instead.  Every
+    SAMPLE_INTERVAL-th item is measured by sizeof(), and max_threshold is
+    set to the number of items of the average size (plus the heap entry)
+    which fit in max_bytes.  min_threshold keeps its ratio to max_threshold.
+
+    >>> heap = BigHeap(max_bytes=200000)
+    >>> heap.extend(['x' * 1000] * 10)
+    >>> 100 < heap.max_threshold < 200, heap.min_threshold == heap.max_threshold // 10
+    (True, True)
+    >>> heap = BigHeap(max_bytes=200000)
+    >>> heap.extend(['x' * 100] * 10)
+    >>> 500 < heap.max_threshold < 1500
+    True
+
     >>> heap = BigHeap()
     >>> heap.append(5)
     >>> heap.append(2)
@@ -58,129 +129,419 @@ class BigHeap(object):
     Traceback (most recent call last):
         ...
     IndexError: pop from empty list
+
+    >>> heap = BigHeap(key=len)
+    >>> for s in ['ccc', 'a', 'bb', 'dd']: heap.append(s)
+    >>> heap
+    BigHeap('a', 'bb', 'dd', 'ccc')
+    >>> [heap.pop() for _ in range(4)]
+    ['ccc', 'dd', 'bb', 'a']
+
+    extend(items) adds many items at once.
+
+    >>> heap = BigHeap(max_threshold=4, min_threshold=2)
+    >>> heap.extend([3, 1, 4, 1, 5, 9, 2, 6])
+    >>> heap
+    BigHeap(6, 9)
+    >>> len(heap)
+    8
+    >>> [heap.pop() for _ in range(8)]
+    [9, 6, 5, 4, 3, 2, 1, 1]
     '''
 
     def __init__(self, *args, **argv):
         self._top_list = []
         self._len = 0
+        self._seq = itertools.count()
+        if argv.get('key'):
+            self._key = argv['key']
+            self._negate = operator.neg
+        else:
+            self._key = lambda item: item
+            self._negate = Descending
         self.max_threshold = argv['max_threshold'] if 'max_threshold' in argv else 10000
         self.min_threshold = argv['min_threshold'] if 'min_threshold' in argv else self.max_threshold // 10
-        self._storage = DistributedItems(self.max_threshold, self.min_threshold)
+        self._storage = DistributedItems(self.max_threshold, self.min_threshold, argv.get('codec'), argv.get('prefetch', False))
+
+        self.max_bytes = argv.get('max_bytes')
+        self._min_ratio = float(self.min_threshold) / self.max_threshold
+        self._appended = 0
+        self._next_sample = 0
+        self._samples = 0
+        self._sampled_bytes = 0
+        self.pop_latencies = collections.deque(maxlen=100000) if argv.get('measure') else None
 
         if args:
             for v in args: self.append(v)
 
+    SAMPLE_INTERVAL = 1000
+    # a (priority, -seq, item) tuple, its two ints and the slot in the heap list
+    ENTRY_BYTES = sys.getsizeof((0, 0, None)) + 2 * sys.getsizeof(0) + 8
+
+    def sample(self, items):
+        '''
+        Measures the items which fall on the sampling interval and adapts
+        the thresholds to max_bytes.
+        '''
+        if self.max_bytes is None: return
+        sampled = False
+        while self._next_sample < self._appended + len(items):
+            self._sampled_bytes += sizeof(items[self._next_sample - self._appended]) + BigHeap.ENTRY_BYTES
+            self._samples += 1
+            self._next_sample += BigHeap.SAMPLE_INTERVAL
+            sampled = True
+        self._appended += len(items)
+        if sampled: self.adapt_thresholds()
+
+    def adapt_thresholds(self):
+        item_bytes = float(self._sampled_bytes) / self._samples
+        self.max_threshold = max(2, int(self.max_bytes / item_bytes))
+        self.min_threshold = max(1, int(self.max_threshold * self._min_ratio))
+        self._storage.max_threshold = self.max_threshold
+        self._storage.min_threshold = self.min_threshold
+
     def append(self, item):
+        self.sample([item])
         self.append_to_top_list(item)
         if len(self._top_list) > self.max_threshold:
             self.save_surplus()
         self._len += 1
 
+    def extend(self, items):
+        items = list(items)
+        self.sample(items)
+        entries = [(self._negate(self._key(item)), -next(self._seq), item) for item in items]
+        if len(entries) * 8 < len(self._top_list):
+            for entry in entries: heapq.heappush(self._top_list, entry)
+        else:
+            self._top_list.extend(entries)
+            heapq.heapify(self._top_list)
+        if len(self._top_list) > self.max_threshold:
+            self.save_surplus()
+        self._len += len(entries)
+
     def append_to_top_list(self, item):
-        my_bisect_insert(self._top_list, item)
+        key = self._key(item)
+        heapq.heappush(self._top_list, (self._negate(key), -next(self._seq), item))
+
+    def to_stored(self, entry):
+        priority, negative_seq, item = entry
+        return (self._key(item), -negative_seq, item)
+
+    def from_stored(self, stored):
+        key, seq, item = stored
+        return (self._negate(key), -seq, item)
 
     def save_surplus(self):
-        surplus = self._top_list[:len(self._top_list) - self.min_threshold]
-        self._top_list = self._top_list[len(self._top_list) - self.min_threshold:]
-        self._storage.store_items(surplus)
+        entries = sorted(self._top_list)
+        self._top_list = entries[:self.min_threshold]   # a sorted list is a heap
+        self._storage.store_items([self.to_stored(e) for e in reversed(entries[self.min_threshold:])])
 
     def pop(self):
+        if self.pop_latencies is None: return self.pop_item()
+        started = time.time()
+        try:
+            return self.pop_item()
+        finally:
+            self.pop_latencies.append(time.time() - started)
+
+    def pop_item(self):
         if len(self._top_list) <= self.min_threshold:
             self.load_surplus()
-        elif self._storage.maximum() and self._top_list[-1] < self._storage.maximum():
+        elif self._storage.maximum() and self.to_stored(self._top_list[0]) < self._storage.maximum():
             self.load_surplus()
+        if not self._top_list: raise IndexError('pop from empty list')
         self._len -= 1
-        return self._top_list.pop()
+        return heapq.heappop(self._top_list)[2]
 
     def load_surplus(self):
-        for item in self._storage.pop_items():
-            my_bisect_insert(self._top_list, item)
+        surplus = self._storage.pop_items()
+        if not surplus: return
+        self._top_list.extend(self.from_stored(s) for s in surplus)
+        heapq.heapify(self._top_list)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99, 99.9, 100)):
+        '''
+        Latencies of recent pops in seconds at the percentiles, by nearest
+        rank.  Needs measure=True.
+
+        >>> heap = BigHeap(3, 1, 2, measure=True)
+        >>> heap.pop(), heap.pop()
+        (3, 2)
+        >>> sorted(heap.latency_percentiles((50, 100)).keys())
+        [50, 100]
+        '''
+        latencies = sorted(self.pop_latencies)
+        if not latencies: return {}
+        rank = lambda p: min(len(latencies), max(1, int(math.ceil(p / 100.0 * len(latencies)))))
+        return dict((p, latencies[rank(p) - 1]) for p in percentiles)
 
     def __repr__(self):
-        return 'BigHeap(' + (', '.join([repr(v) for v in self._top_list])) + ')'
+        return 'BigHeap(' + (', '.join([repr(e[2]) for e in sorted(self._top_list, reverse=True)])) + ')'
 
     def __len__(self):
         return self._len
 
 
+class SegmentStore(object):
+    '''
+    Records appended to a single temporary file and found through an offset
+    index.  A freed record at the end of the file is reclaimed at once;
+    others are left as garbage until it outweighs the live records (and
+    compact_bytes), then the live records are copied to a fresh file.  The
+    file is a TemporaryFile, so it is removed on close() or when the process
+    exits, even when it crashes.
+
+    >>> store = SegmentStore(compact_bytes=0)
+    >>> a = store.write('first')
+    >>> b = store.write('second')
+    >>> c = store.write('third')
+    >>> store.free(c)
+    >>> store.size(), store.garbage
+    (11, 0)
+    >>> store.free(a)
+    >>> store.size(), store.garbage
+    (6, 5)
+    >>> store.free(b)
+    >>> store.size(), store.garbage
+    (0, 0)
+    >>> d = store.write('fourth')
+    >>> e = store.write('fifth')
+    >>> store.free(d)
+    >>> store.size(), store.garbage
+    (5, 0)
+    >>> store.read(e)
+    'fifth'
+    '''
+    def __init__(self, compact_bytes=1 << 24):
+        self.compact_bytes = compact_bytes
+        self._file = tempfile.TemporaryFile()
+        self._map = None
+        self._index = {}    # record -> (offset, length)
+        self._records = itertools.count()
+        self._end = 0
+        self.live = 0
+        self.garbage = 0
+
+    def write(self, data):
+        self._file.seek(self._end)
+        self._file.write(data)
+        record = next(self._records)
+        self._index[record] = (self._end, len(data))
+        self._end += len(data)
+        self.live += len(data)
+        return record
+
+    def read(self, record):
+        offset, length = self._index[record]
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def mapped(self, record):
+        '''
+        Returns (mmap of the file, offset, length) of the record, to read it
+        without copying.  The map is only valid until the next call.
+        '''
+        offset, length = self._index[record]
+        self._file.flush()
+        if self._map is None or len(self._map) < offset + length:
+            self.unmap()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map, offset, length
+
+    def unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def free(self, record):
+        offset, length = self._index.pop(record)
+        self.live -= length
+        if offset + length == self._end:
+            self._end = offset
+        else:
+            self.garbage += length
+        if self.garbage > max(self.live, self.compact_bytes):
+            self.compact()
+
+    def compact(self):
+        compacted = tempfile.TemporaryFile()
+        index = {}
+        end = 0
+        for record, (offset, length) in sorted(self._index.items(), key=lambda r: r[1]):
+            self._file.seek(offset)
+            compacted.write(self._file.read(length))
+            index[record] = (end, length)
+            end += length
+        self.unmap()
+        self._file.close()
+        self._file = compacted
+        self._index = index
+        self._end = end
+        self.garbage = 0
+
+    def size(self):
+        return self._end - self.garbage
+
+    def close(self):
+        self.unmap()
+        self._file.close()
+
+
 class DistributedItems(object):
+    '''
+    Sorted items split into fragments.  Every item in a fragment is
+    greater than the maximum of the previous fragment, so an item is routed
+    by binary search over the maxima.
+
+    >>> storage = DistributedItems(4, 2)
+    >>> storage.store_items([1, 3, 5, 7])
+    >>> storage.store_items([0, 4, 4, 8, 9])
+    >>> storage._maxima
+    [3, 7, 9]
+    >>> storage.pop_items()
+    [8, 9]
+    >>> storage.maximum()
+    7
+    '''
     class Fragment(object):
-        def __init__(self, filename, maximum):
-            self.filename = filename
+        '''
+        A sorted list of items as one record of a SegmentStore.  Items are
+        pickled, or packed as an array of (key, seq, item) records when
+        there is a codec.
+        '''
+        ENTRY = struct.Struct('<qQ')
+
+        def __init__(self, store, codec, record, maximum):
+            self.store = store
+            self.codec = codec
+            self.record = record
             self.maximum = maximum
 
         def __cmp__(self, other):
             return cmp(self.maximum, other.maximum)
 
+        def dumps(self, items):
+            if not self.codec: return pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+            pack, encode = DistributedItems.Fragment.ENTRY.pack, self.codec.encode
+            return ''.join(pack(key, seq) + encode(item) for key, seq, item in items)
+
+        def load(self):
+            if not self.codec: return self.loads(self.store.read(self.record))
+            return self.loads(*self.store.mapped(self.record))
+
+        def loads(self, data, start=0, length=None):
+            if not self.codec: return pickle.loads(data)
+            if length is None: length = len(data) - start
+            unpack_from, decode = DistributedItems.Fragment.ENTRY.unpack_from, self.codec.decode
+            entry_size = DistributedItems.Fragment.ENTRY.size
+            items = []
+            for offset in xrange(start, start + length, entry_size + self.codec.size):
+                key, seq = unpack_from(data, offset)
+                items.append((key, seq, decode(data, offset + entry_size)))
+            return items
+
         def store_items(self, items):
-            f = open(self.filename, 'wb')
-            pickle.dump(items, f)
-            f.close()
+            self.store.free(self.record)
+            self.record = self.store.write(self.dumps(items))
             self.maximum = items[-1]
 
         def discard(self):
-            os.remove(self.filename)
+            self.store.free(self.record)
             self.maximum = None
 
         @staticmethod
-        def create(items):
-            f = tempfile.NamedTemporaryFile(delete=False)
-            pickle.dump(items, f)
-            f.close()
-            return DistributedItems.Fragment(f.name, items[-1])
+        def create(store, codec, items):
+            frag = DistributedItems.Fragment(store, codec, None, items[-1])
+            frag.record = store.write(frag.dumps(items))
+            return frag
 
-    def __init__(self, max_threshold, min_threshold):
+    def __init__(self, max_threshold, min_threshold, codec=None, prefetch=False):
         self.max_threshold = max_threshold
         self.min_threshold = min_threshold
+        self.codec = codec
+        self._store = SegmentStore()
         self._fragments = []
+        self._maxima = []   # maximum of each fragment, in the same order
+        self.prefetch = prefetch
+        self._lock = threading.Lock()   # guards the store against the prefetcher
+        self._prefetcher = None
+        self._prefetched = None     # (fragment, record, items)
 
-    def save_new_files(self, items):
-        while items:
-            new_items = items[:self.min_threshold]
-            items = items[self.min_threshold:]
-            my_bisect_insert(self._fragments, DistributedItems.Fragment.create(new_items))
+    def new_fragments(self, items):
+        return [DistributedItems.Fragment.create(self._store, self.codec, items[start:start + self.min_threshold])
+                for start in range(0, len(items), self.min_threshold)]
 
     def store_items(self, items):
-        distribution = [[] for _ in self._fragments] + [[]]
-        for item in items:
-            for i, frag in enumerate(self._fragments):
-                if item <= frag.maximum:
-                    distribution[i].append(item)
-                    break
-            else:
-                distribution[-1].append(item)
-
-        for i, frag in enumerate(self._fragments[:]):
-            # self._fragments is copied so it's safe to add/remove frags in this loop
-            if not distribution[i]: continue
-            f = open(frag.filename)
-            loaded = pickle.load(f)
-            f.close()
-            for item in distribution[i]:
-                my_bisect_insert(loaded, item)
+        with self._lock:
+            self.merge_items(items)
+        self.start_prefetch()
 
+    def merge_items(self, items):
+        items = sorted(items)   # cheap when already sorted, as from BigHeap
+        fragments = []
+        start = 0
+        for frag, maximum in zip(self._fragments, self._maxima):
+            # items over the previous maximum and up to this one go to frag
+            end = bisect.bisect_right(items, maximum, start)
+            if start == end:
+                fragments.append(frag)
+                continue
+            loaded = list(heapq.merge(frag.load(), items[start:end]))
+            start = end
             if len(loaded) > self.max_threshold:
-                self._fragments.remove(frag)
                 frag.discard()
-                self.save_new_files(loaded)
+                fragments += self.new_fragments(loaded)
             else:
                 frag.store_items(loaded)
+                fragments.append(frag)
+        fragments += self.new_fragments(items[start:])
 
-        if distribution[-1]:
-            new_list = []
-            for item in distribution[-1]:
-                my_bisect_insert(new_list, item)
-            self.save_new_files(new_list)
+        self._fragments = fragments
+        self._maxima = [frag.maximum for frag in fragments]
 
     def pop_items(self):
         if not self._fragments: return []
-        frag = self._fragments.pop()
-        f = open(frag.filename)
-        surplus = pickle.load(f)
-        f.close()
-        os.remove(frag.filename)
+        with self._lock:
+            frag = self._fragments.pop()
+            self._maxima.pop()
+            prefetched, self._prefetched = self._prefetched, None
+            if prefetched and prefetched[0] is frag and prefetched[1] == frag.record:
+                surplus = prefetched[2]
+            else:
+                surplus = frag.load()
+            frag.discard()
+        self.start_prefetch()
         return surplus
 
+    def start_prefetch(self):
+        '''
+        Starts reading the last fragment in background unless it is already
+        read or being read.  A fragment changed after it is read is loaded
+        again by pop_items.
+        '''
+        if not self.prefetch or not self._fragments: return
+        if self._prefetcher and self._prefetcher.is_alive(): return
+        prefetched = self._prefetched
+        if prefetched and prefetched[0] is self._fragments[-1] and prefetched[1] == prefetched[0].record: return
+        self._prefetcher = threading.Thread(target=self.prefetch_last)
+        self._prefetcher.daemon = True
+        self._prefetcher.start()
+
+    def prefetch_last(self):
+        with self._lock:
+            if not self._fragments: return
+            frag = self._fragments[-1]
+            record = frag.record
+            data = self._store.read(record)
+        items = frag.loads(data)
+        with self._lock:
+            self._prefetched = (frag, record, items)
+
     def maximum(self):
-        if not self._fragments: return None
-        return self._fragments[-1].maximum
+        if not self._maxima: return None
+        return self._maxima[-1]
+
+    def close(self):
+        if self._prefetcher: self._prefetcher.join()
+        self._store.close()
@@ -5,11 +5,22 @@ from hamcrest import *
 import tempfile
 import os
 import random
+import struct
 
-import pickle
 import bigheap
 
 
+class PairCodec(object):
+    '''
+    Packs (int, int) pairs for BigHeap tests.
+    '''
+    size = 8
+    def encode(self, item):
+        return struct.pack('<ii', *item)
+    def decode(self, data, offset=0):
+        return struct.unpack_from('<ii', data, offset)
+
+
 class BigHeapTest(unittest.TestCase):
     def test_initial(self):
         heap = bigheap.BigHeap()
@@ -55,9 +66,7 @@ class BigHeapTest(unittest.TestCase):
         for i in items: heap.append(i)
 
         for frag in heap._storage._fragments:
-            f = open(frag.filename)
-            loaded = pickle.load(f)
-            f.close()
+            loaded = frag.load()
 
             assert_that(len(loaded), is_not(greater_than(heap.max_threshold)))
             for i in loaded:
@@ -65,7 +74,79 @@ class BigHeapTest(unittest.TestCase):
         
         while len(heap) > 0: heap.pop()
         assert_that(len(heap._storage._fragments), is_(0))
+        assert_that(heap._storage._store.size(), is_(0))
+
+
+    def test_items_with_key_over_threshold(self):
+        heap = bigheap.BigHeap(max_threshold=20, min_threshold=8, key=lambda v: -v[0])
+        items = [(i // 3, i) for i in range(300)]
+        random.shuffle(items)
+        for i in items: heap.append(i)
+
+        retrieved = []
+        while len(heap) > 0:
+            retrieved.append(heap.pop()[0])
+        assert_that(retrieved, is_(sorted(v for v, _ in items)))
+
+    def test_latest_of_equal_items_comes_first(self):
+        heap = bigheap.BigHeap(max_threshold=10, min_threshold=3, key=lambda v: v[0])
+        for i in range(30): heap.append((i % 2, i))
+        retrieved = [heap.pop()[1] for _ in range(30)]
+        assert_that(retrieved, is_(range(29, 0, -2) + range(28, -1, -2)))
+
+    def test_extend_with_batches_over_threshold(self):
+        heap = bigheap.BigHeap(max_threshold=20, min_threshold=8)
+        items = range(10 * 100) * 2
+        random.shuffle(items)
+        for start in range(0, len(items), 70):
+            heap.extend(items[start:start + 70])
+        assert_that(len(heap), is_(len(items)))
+
+        for frag in heap._storage._fragments:
+            loaded = frag.load()
+            assert_that(loaded, is_(sorted(loaded)))
+            assert_that(len(loaded), is_not(greater_than(heap.max_threshold)))
+        assert_that(heap._storage._maxima, is_(sorted(heap._storage._maxima)))
+
+        retrieved = []
+        while len(heap) > 0:
+            retrieved.append(heap.pop())
+        items.sort(reverse=True)
+        assert_that(retrieved, is_(items))
+        assert_that(len(heap._storage._fragments), is_(0))
+
+    def test_items_spilled_with_codec(self):
+        heap = bigheap.BigHeap(max_threshold=20, min_threshold=8, key=lambda v: v[0], codec=PairCodec())
+        items = [(i % 97, i) for i in range(1000)]
+        random.shuffle(items)
+        for start in range(0, len(items), 30):
+            heap.extend(items[start:start + 30])
+        assert_that(len(heap._storage._fragments), greater_than(0))
 
+        retrieved = []
+        while len(heap) > 0:
+            retrieved.append(heap.pop())
+        assert_that(sorted(retrieved), is_(sorted(items)))
+        assert_that([v for v, _ in retrieved], is_(sorted([v for v, _ in items], reverse=True)))
+        assert_that(heap._storage._store.size(), is_(0))
+
+    def test_prefetched_fragments(self):
+        for codec in [None, PairCodec()]:
+            heap = bigheap.BigHeap(max_threshold=20, min_threshold=8, key=lambda v: v[0], codec=codec, prefetch=True, measure=True)
+            items = [(i % 97, i) for i in range(1000)]
+            random.shuffle(items)
+            retrieved = []
+            for start in range(0, len(items), 50):
+                heap.extend(items[start:start + 50])
+                retrieved += [heap.pop() for _ in range(10)]
+            while len(heap) > 0:
+                retrieved.append(heap.pop())
+            assert_that(sorted(retrieved), is_(sorted(items)))
+            assert_that(heap._storage._store.size(), is_(0))
+
+            percentiles = heap.latency_percentiles()
+            assert_that(percentiles[50], less_than_or_equal_to(percentiles[100]))
+            assert_that(len(heap.pop_latencies), is_(len(items)))
 
 
 if __name__=='__main__':
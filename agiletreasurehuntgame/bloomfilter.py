@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import math
+import mmap
+import multiprocessing
+
+class BloomFilter(object):
+    '''
+    A Bloom filter of int keys in an anonymous shared mmap, so processes
+    forked after it is made share its bits.  Sized for capacity keys at
+    error_rate false positives; more keys raise the rate.  A negative
+    answer is always right.  Additions take a lock, as setting a bit
+    rewrites its byte.
+
+    >>> bloom = BloomFilter(1000, 0.01)
+    >>> bloom.bits, bloom.hashes
+    (9586, 7)
+    >>> for key in range(0, 3000, 3): bloom.add(key)
+    >>> all(key in bloom for key in range(0, 3000, 3))
+    True
+    >>> sum(1 for key in range(1, 3000, 3) if key in bloom) < 30
+    True
+    '''
+    MASK = (1 << 64) - 1
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+        self._map = mmap.mmap(-1, (self.bits + 7) // 8)
+        self._lock = multiprocessing.Lock()
+
+    def positions(self, key):
+        # double hashing over two multiplicative hashes of the key
+        h = hash(key)
+        h1 = (h * 0x9E3779B97F4A7C15) & BloomFilter.MASK
+        h2 = ((h * 0xC2B2AE3D27D4EB4F) & BloomFilter.MASK) | 1
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def __contains__(self, key):
+        m = self._map
+        for p in self.positions(key):
+            if not ord(m[p >> 3]) & (1 << (p & 7)): return False
+        return True
+
+    def add(self, key):
+        m = self._map
+        with self._lock:
+            for p in self.positions(key):
+                m[p >> 3] = chr(ord(m[p >> 3]) | (1 << (p & 7)))
+
+    def nbytes(self):
+        return len(self._map)
+
+
+class FilteredProcessed(object):
+    '''
+    Puts a BloomFilter in front of a processed table, such as a Manager
+    dict proxy, so that ids never added are answered without asking the
+    table.  Counts, per process, lookups answered by the filter
+    (filtered), lookups passed to the table and found (hits), and passed
+    but not found (false_positives).
+
+    >>> processed = FilteredProcessed({}, BloomFilter(100, 0.01))
+    >>> processed[5] = 2
+    >>> processed.get(5), processed.get(6), 5 in processed, len(processed)
+    (2, None, True, 1)
+    >>> processed.filtered, processed.hits, processed.false_positives
+    (1, 2, 0)
+    '''
+    def __init__(self, table, bloom):
+        self.table = table
+        self.bloom = bloom
+        self.filtered = 0
+        self.hits = 0
+        self.false_positives = 0
+
+    def get(self, key, default=None):
+        if key not in self.bloom:
+            self.filtered += 1
+            return default
+        value = self.table.get(key)
+        if value is None:
+            self.false_positives += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        # the filter first: a reader may then go to the table for nothing,
+        # but never misses an id which is in the table
+        self.bloom.add(key)
+        self.table[key] = value
+
+    def __len__(self):
+        return len(self.table)
+
+    def stats(self):
+        return 'filtered:%d, hits:%d, false positives:%d'%(self.filtered, self.hits, self.false_positives)
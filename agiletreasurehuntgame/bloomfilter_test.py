@@ -0,0 +1,48 @@
+# coding: utf-8
+
+import unittest
+from hamcrest import *
+import multiprocessing
+import random
+
+from bloomfilter import BloomFilter, FilteredProcessed
+
+
+def add_keys(bloom, keys):
+    for key in keys: bloom.add(key)
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_false_positive_rate(self):
+        for error_rate in [0.1, 0.01]:
+            bloom = BloomFilter(10000, error_rate)
+            added = set(random.getrandbits(63) for _ in range(10000))
+            add_keys(bloom, added)
+            for key in added:
+                assert_that(key in bloom, is_(True))
+            others = [random.getrandbits(63) for _ in range(20000)]
+            false_positives = sum(1 for key in others if key in bloom and key not in added)
+            assert_that(false_positives, less_than(len(others) * error_rate * 1.5))
+
+    def test_shared_with_forked_processes(self):
+        bloom = BloomFilter(10000, 0.01)
+        processes = [multiprocessing.Process(target=add_keys, args=(bloom, range(i, 4000, 4))) for i in range(4)]
+        [p.start() for p in processes]
+        [p.join() for p in processes]
+        for key in range(4000):
+            assert_that(key in bloom, is_(True))
+
+    def test_filtered_table_matches_table(self):
+        processed = FilteredProcessed({}, BloomFilter(1000, 0.05))
+        expected = {}
+        for _ in range(3000):
+            key = random.randint(0, 3000)
+            if random.random() < 0.3:
+                processed[key] = expected[key] = random.randint(0, 5)
+            assert_that(processed.get(key), is_(expected.get(key)))
+        assert_that(len(processed), is_(len(expected)))
+        assert_that(processed.filtered + processed.hits + processed.false_positives, is_(3000))
+
+
+if __name__=='__main__':
+    unittest.main()
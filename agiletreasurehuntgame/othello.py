@@ -2,8 +2,15 @@
 
 import datetime
 import bisect
+import itertools
+import operator
+import os
+import random
+import struct
+import threading
+import weakref
 
-from agiletreasurehuntgame.search import Search, MultiprocessingFlavor
+from agiletreasurehuntgame.search import Search, MultiprocessingFlavor, BigHeapFlavor, CompactProcessedFlavor, SpillingProcessedFlavor, DynamicProgrammingSearch, LayeredSearch
 
 class Board(object):
     '''
@@ -15,9 +22,9 @@ class Board(object):
      '......',
      '......',
      '......')
-    >>> b.place(0, 0, Board.BLACK)
-    >>> b.place(0, 1, Board.WHITE)
-    >>> b.place(0, 2, Board.WHITE)
+    >>> _ = b.place(0, 0, Board.BLACK)
+    >>> _ = b.place(0, 1, Board.WHITE)
+    >>> _ = b.place(0, 2, Board.WHITE)
     >>> print b.dump()
     ('BWW...',
      '......',
@@ -25,7 +32,7 @@ class Board(object):
      '......',
      '......',
      '......')
-    >>> b.place(0, 3, Board.BLACK)
+    >>> _ = b.place(0, 3, Board.BLACK)
     >>> print b.dump()
     ('BBBB..',
      '......',
@@ -35,13 +42,13 @@ class Board(object):
      '......')
     >>> b.flip_count
     {'BtoW': 0, 'WtoB': 2}
-    >>> b.place(2, 2, Board.BLACK)
-    >>> b.place(3, 3, Board.BLACK)
-    >>> b.place(1, 4, Board.BLACK)
-    >>> b.place(2, 4, Board.BLACK)
-    >>> b.place(3, 4, Board.BLACK)
-    >>> b.place(1, 1, Board.WHITE)
-    >>> b.place(0, 4, Board.WHITE)
+    >>> _ = b.place(2, 2, Board.BLACK)
+    >>> _ = b.place(3, 3, Board.BLACK)
+    >>> _ = b.place(1, 4, Board.BLACK)
+    >>> _ = b.place(2, 4, Board.BLACK)
+    >>> _ = b.place(3, 4, Board.BLACK)
+    >>> _ = b.place(1, 1, Board.WHITE)
+    >>> _ = b.place(0, 4, Board.WHITE)
     >>> print b.dump()
     ('BBBBW.',
      '.W..B.',
@@ -49,7 +56,7 @@ class Board(object):
      '...BB.',
      '......',
      '......')
-    >>> b.place(4, 4, Board.WHITE)
+    >>> _ = b.place(4, 4, Board.WHITE)
     >>> print b.dump()
     ('BBBBW.',
      '.W..W.',
@@ -59,6 +66,8 @@ class Board(object):
      '......')
     >>> b.flip_count
     {'BtoW': 5, 'WtoB': 2}
+    >>> b.count(Board.WHITE), b.count(Board.BLACK), b.count(Board.EMPTY)
+    (8, 4, 24)
 
     To copy a board, use Board(old_board.state())
 
@@ -70,16 +79,22 @@ class Board(object):
     >>> b.place_history == b2.place_history
     True
 
+    States of both backends can be passed to either of them.
+
+    >>> b3 = Board(BitBoard(b.state()).state())
+    >>> b.dump() == b3.dump() and b.hashes == b3.hashes
+    True
+
     All place() calls are logged in place_history
 
     >>> b = Board()
     >>> b.place_history
     []
-    >>> b.place(0, 0, Board.WHITE)
+    >>> _ = b.place(0, 0, Board.WHITE)
     >>> b.place_history
     [(0, 0, 1)]
-    >>> b.place(1, 1, Board.WHITE)
-    >>> b.place(2, 2, Board.BLACK)
+    >>> _ = b.place(1, 1, Board.WHITE)
+    >>> _ = b.place(2, 2, Board.BLACK)
     >>> b.place_history
     [(0, 0, 1), (1, 1, 1), (2, 2, 2)]
     '''
@@ -100,6 +115,9 @@ class Board(object):
 
         if 'board' in state:
             self.board = state['board']
+        elif 'bits' in state:
+            # the state of a BitBoard
+            self.board = BitBoard.cells_of(state['bits'], self.width * self.height)
         else:
             self.board = [Board.EMPTY] * (self.width * self.height)
 
@@ -113,16 +131,108 @@ class Board(object):
         else:
             self.place_history = []
 
+        # number of cells of each color, indexed by color
+        self.counts = [self.board.count(color) for color in (Board.EMPTY, Board.WHITE, Board.BLACK)]
+
+        self.rays = Board.ray_table(self.width, self.height)
+        self.init_hashes(state)
+
+    def init_hashes(self, state={}):
+        '''
+        Keeps one zobrist hash per symmetry of the board size, updated as
+        cells change.  min(self.hashes) is the same for symmetric boards.
+        '''
+        self.normalizer = BoardNormalizer.of(self.width, self.height)
+        if 'hashes' in state:
+            self.hashes = state['hashes']
+        else:
+            self.hashes = self.normalizer.hashes(self)
+
+    _ray_tables = {}
+
+    @staticmethod
+    def ray_table(width, height):
+        '''
+        For each cell index, returns one ray per vector: the indices of the
+        cells met by walking from the cell to the edge of the board.
+        Rays which are empty are left out.  Tables are built once per
+        board size.
+
+        >>> rays = Board.ray_table(3, 2)
+        >>> rays[0]
+        [(2, 4), (1,), (3,)]
+        >>> rays[3]
+        [(0,), (2,), (4,), (1,), (5,)]
+        '''
+        key = (width, height)
+        if key not in Board._ray_tables:
+            table = []
+            for c in range(width):
+                for r in range(height):
+                    rays = []
+                    for dr, dc in Board.VECTORS:
+                        ray = []
+                        rr, cc = r + dr, c + dc
+                        while 0 <= rr < height and 0 <= cc < width:
+                            ray.append(rr + cc * height)
+                            rr, cc = rr + dr, cc + dc
+                        if ray: rays.append(tuple(ray))
+                    table.append(rays)
+            Board._ray_tables[key] = table
+        return Board._ray_tables[key]
+
+    def reachable_flips(self, budget):
+        '''
+        Most pieces that one placement on a cell which is empty now can turn
+        when at most budget other cells are filled before it.  Along each
+        ray, the turned pieces and the piece closing them must be on cells
+        which are filled now or are among those budget cells.
+
+        >>> b = Board(width=4, height=4)
+        >>> b.reachable_flips(1), b.reachable_flips(2), b.reachable_flips(9)
+        (0, 3, 6)
+        >>> _ = b.place(1, 1, Board.WHITE)
+        >>> b.reachable_flips(0), b.reachable_flips(1)
+        (0, 1)
+        '''
+        board = self.board
+        best = 0
+        for index, rays in enumerate(self.rays):
+            if board[index] != Board.EMPTY: continue
+            flips = 0
+            for ray in rays:
+                left = budget
+                reach = 0
+                for i in ray:
+                    if board[i] == Board.EMPTY:
+                        if not left: break
+                        left -= 1
+                    reach += 1
+                if reach > 1: flips += reach - 1
+            if flips > best: best = flips
+        return best
+
     def state(self):
         return {
             'board': self.board[:],
             'flip_count': dict(self.flip_count),
             'place_history': self.place_history[:],
             'size': (self.width, self.height),
+            'hashes': self.hashes[:],
         }
 
-    @staticmethod
-    def build(initial):
+    def copy(self):
+        return self.__class__(self.state())
+
+    def __getstate__(self):
+        # lookup tables are shared per size and must not travel with pickles
+        return self.state()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    @classmethod
+    def build(cls, initial):
         '''
         >>> initial = (
         ...   '..WB.B',
@@ -144,11 +254,12 @@ class Board(object):
         >>>
         '''
         w, h = len(initial), len(initial[0])
-        board = Board(width=w, height=h)
+        board = cls(width=w, height=h)
         for r in range(h):
             for c in range(w):
                 color = Board.CHARS.index(initial[r][c])
-                board.board[board._index(r, c)] = color
+                board._set(board._index(r, c), color)
+        board.init_hashes()
         return board
 
     def dump(self, history=False):
@@ -172,22 +283,100 @@ class Board(object):
     def get(self, row, col):
         return self.board[self._index(row, col)]
 
+    def _get(self, index):
+        return self.board[index]
+
+    def cells(self):
+        '''
+        Returns colors of all cells ordered by index.
+        '''
+        return self.board
+
+    def count(self, color):
+        '''
+        Returns how many cells are of color.
+        '''
+        return self.counts[color]
+
+    def encode(self, weights):
+        '''
+        Returns the sum of the weights of the cells times their colors.
+        '''
+        return sum(map(operator.mul, self.board, weights))
+
+    def _set(self, index, color):
+        self.counts[self.board[index]] -= 1
+        self.counts[color] += 1
+        self.board[index] = color
+
     def place(self, row, col, color):
-        assert self.get(row, col) == Board.EMPTY
-        self.board[self._index(row, col)] = color
-        self.turn(placed=(row, col))
+        '''
+        Places a piece in place and returns an undo record for unplace().
+
+        >>> b = Board(width=4, height=1)
+        >>> _ = b.place(0, 0, Board.BLACK)
+        >>> _ = b.place(0, 1, Board.WHITE)
+        >>> _ = b.place(0, 2, Board.WHITE)
+        >>> undo = b.place(0, 3, Board.BLACK)
+        >>> undo
+        (0, 3, 2, [2, 1])
+        >>> print b.dump(history=True)
+        ('BBBB')(0, 0, 2)(0, 1, 1)(0, 2, 1)(0, 3, 2)
+        >>> b.unplace(undo)
+        >>> print b.dump(history=True)
+        ('BWW.')(0, 0, 2)(0, 1, 1)(0, 2, 1)
+        >>> b.flip_count
+        {'BtoW': 0, 'WtoB': 0}
+        '''
+        index = self._index(row, col)
+        assert self.board[index] == Board.EMPTY
+        self.board[index] = color
+        turned = self.turnable(index, color)
+        for i in turned:
+            self.board[i] = color
+        if color == Board.WHITE:
+            self.flip_count['BtoW'] += len(turned)
+            self.counts[Board.BLACK] -= len(turned)
+        else:
+            self.flip_count['WtoB'] += len(turned)
+            self.counts[Board.WHITE] -= len(turned)
+        self.counts[color] += 1 + len(turned)
+        self.counts[Board.EMPTY] -= 1
+        self.hashes = map(operator.xor, self.hashes, self.normalizer.hash_delta(index, color, turned))
         self.place_history.append((row, col, color))
+        return (row, col, color, turned)
 
-    def turn(self, placed):
-        for row, col, before_color in self.turnable(placed):
-            self.flip(row, col)
-
-    def turnable(self, placed):
+    def unplace(self, undo):
+        row, col, color, turned = undo
+        if color == Board.WHITE:
+            self.flip_count['BtoW'] -= len(turned)
+            before_color = Board.BLACK
+        else:
+            self.flip_count['WtoB'] -= len(turned)
+            before_color = Board.WHITE
+        for i in turned:
+            self.board[i] = before_color
+        self.counts[before_color] += len(turned)
+        self.counts[color] -= 1 + len(turned)
+        self.counts[Board.EMPTY] += 1
+        index = self._index(row, col)
+        self.board[index] = Board.EMPTY
+        self.hashes = map(operator.xor, self.hashes, self.normalizer.hash_delta(index, color, turned))
+        self.place_history.pop()
+
+    def turnable(self, index, color):
+        '''
+        Returns indices of the cells which are turned by placing color at index.
+        '''
+        board = self.board
         turnable = []
-        placed_row, placed_col = placed
-        for v in Board.VECTORS:
-            line = self.get_line(placed_row, placed_col, v)
-            turnable += self.turnable_in_line(line)
+        for ray in self.rays[index]:
+            for n, i in enumerate(ray):
+                c = board[i]
+                if c == Board.EMPTY: break
+                if c == color:
+                    turnable.extend(ray[:n])
+                    break
         return turnable
 
     def flip(self, row, col):
@@ -198,7 +387,11 @@ class Board(object):
         elif self.get(row, col) == Board.WHITE:
             new_color = Board.BLACK
             self.flip_count['WtoB'] += 1
-        self.board[self._index(row, col)] = new_color
+        index = self._index(row, col)
+        self.board[index] = new_color
+        self.counts[new_color] += 1
+        self.counts[Board.WHITE + Board.BLACK - new_color] -= 1
+        self.hashes = map(operator.xor, self.hashes, self.normalizer.flip_keys[index])
 
     def get_line(self, row, col, v):
         '''
@@ -219,140 +412,711 @@ class Board(object):
         [(5, 4, 1), (4, 3, 2), (3, 2, 2)]
         '''
         line = []
-        for i in xrange(1000):
-            r = row + v[0] * i
-            c = col + v[1] * i
-            if r < 0 or self.height <= r or c < 0 or self.width <= c: break
-            if self.get(r, c) == Board.EMPTY:
-                break
-            line.append((r, c, self.get(r, c)))
+        if self.get(row, col) == Board.EMPTY: return line
+        line.append((row, col, self.get(row, col)))
+        dr, dc = v
+        if 0 <= row + dr < self.height and 0 <= col + dc < self.width:
+            rays = self.rays[self._index(row, col)]
+            ray = [r for r in rays if r[0] == self._index(row + dr, col + dc)][0]
+            for i in ray:
+                color = self._get(i)
+                if color == Board.EMPTY: break
+                line.append((i % self.height, i // self.height, color))
         return line
 
-    def turnable_in_line(self, line):
-        head = line[0][2]
-        middle = []
-        tail = None
-        for i in range(1, len(line)):
-            if line[i][2] == head:
-                tail = line[i][2]
-                break
-            middle.append(line[i])
-        if tail:
-            return middle
+
+class BitBoard(Board):
+    '''
+    Same protocol as Board, but each color is kept as an integer bitmask.
+    Bit i stands for the cell at Board._index(), and flips are found by
+    shifting masks along each vector instead of building lines of tuples.
+
+    >>> b = BitBoard()
+    >>> _ = b.place(0, 0, Board.BLACK)
+    >>> _ = b.place(0, 1, Board.WHITE)
+    >>> _ = b.place(0, 2, Board.WHITE)
+    >>> _ = b.place(0, 3, Board.BLACK)
+    >>> print b.dump()
+    ('BBBB..',
+     '......',
+     '......',
+     '......',
+     '......',
+     '......')
+    >>> b.flip_count
+    {'BtoW': 0, 'WtoB': 2}
+    >>> _ = b.place(2, 2, Board.BLACK)
+    >>> _ = b.place(3, 3, Board.BLACK)
+    >>> _ = b.place(1, 4, Board.BLACK)
+    >>> _ = b.place(2, 4, Board.BLACK)
+    >>> _ = b.place(3, 4, Board.BLACK)
+    >>> _ = b.place(1, 1, Board.WHITE)
+    >>> _ = b.place(0, 4, Board.WHITE)
+    >>> _ = b.place(4, 4, Board.WHITE)
+    >>> print b.dump()
+    ('BBBBW.',
+     '.W..W.',
+     '..W.W.',
+     '...WW.',
+     '....W.',
+     '......')
+    >>> b.flip_count
+    {'BtoW': 5, 'WtoB': 2}
+    >>> b.count(Board.WHITE), b.count(Board.BLACK), b.count(Board.EMPTY)
+    (8, 4, 24)
+    >>> b.reachable_flips(0), b.reachable_flips(2)
+    (4, 11)
+
+    Boards of other shapes must not wrap around the edges.
+
+    >>> b = BitBoard.build((
+    ...   '.W..',
+    ...   '....',
+    ...   '....',
+    ...   'B...',
+    ... ))
+    >>> _ = b.place(2, 0, Board.WHITE)
+    >>> print b.dump()
+    ('.W..',
+     '....',
+     'W...',
+     'B...')
+    >>> b = BitBoard(width=3, height=2)
+    >>> _ = b.place(1, 0, Board.BLACK)
+    >>> _ = b.place(1, 1, Board.WHITE)
+    >>> b2 = b.copy()
+    >>> undo = b.place(1, 2, Board.BLACK)
+    >>> undo[:4]
+    (1, 2, 2, 8)
+    >>> b.unplace(undo)
+    >>> b.dump() == b2.dump() and b.flip_count == b2.flip_count
+    True
+    >>> b.place_history == b2.place_history
+    True
+    >>> _ = b.place(1, 2, Board.BLACK)
+    >>> _ = b.place(0, 2, Board.WHITE)
+    >>> print b.dump()
+    ('..W',
+     'BBB')
+
+    turnable() and get_line() read the masks too.
+
+    >>> b = BitBoard(width=4, height=1)
+    >>> _ = b.place(0, 0, Board.WHITE)
+    >>> _ = b.place(0, 1, Board.BLACK)
+    >>> _ = b.place(0, 2, Board.BLACK)
+    >>> b.turnable(b._index(0, 3), Board.WHITE)
+    [1, 2]
+    >>> b.get_line(0, 0, (0, 1))
+    [(0, 0, 1), (0, 1, 2), (0, 2, 2)]
+    '''
+    _shift_masks = {}
+    _reach_tables = {}
+
+    def __init__(self, state={}, width=6, height=6):
+        if 'size' in state:
+            self.width = state['size'][0]
+            self.height = state['size'][1]
+        else:
+            self.width = width
+            self.height = height
+
+        if 'bits' in state:
+            self.white, self.black = state['bits']
+        else:
+            self.white = self.black = 0
+            for index, color in enumerate(state.get('board', [])):
+                if color != Board.EMPTY: self._set(index, color)
+
+        if 'flip_count' in state:
+            self.flip_count = state['flip_count']
+        else:
+            self.flip_count = { 'BtoW': 0, 'WtoB': 0 }
+
+        if 'place_history' in state:
+            self.place_history = state['place_history']
+        else:
+            self.place_history = []
+
+        self.rays = Board.ray_table(self.width, self.height)
+        self.shifts = BitBoard.shift_masks(self.width, self.height)
+        self.reaches = BitBoard.reach_table(self.width, self.height)
+        self.init_hashes(state)
+
+    @staticmethod
+    def shift_masks(width, height):
+        '''
+        For each vector, returns (distance, mask) where mask holds the cells
+        which still have a neighbor on the board in that direction.
+        Masks are built once per board size.
+
+        >>> BitBoard.shift_masks(2, 2)
+        [(-3, 8), (-1, 10), (1, 2), (-2, 12), (2, 3), (-1, 4), (1, 5), (3, 1)]
+        '''
+        key = (width, height)
+        if key not in BitBoard._shift_masks:
+            shifts = []
+            for dr, dc in Board.VECTORS:
+                mask = 0
+                for r in range(height):
+                    for c in range(width):
+                        if 0 <= r + dr < height and 0 <= c + dc < width:
+                            mask |= 1 << (r + c * height)
+                shifts.append((dr + dc * height, mask))
+            BitBoard._shift_masks[key] = shifts
+        return BitBoard._shift_masks[key]
+
+    @staticmethod
+    def reach_table(width, height):
+        '''
+        Returns (most flips, bit, rays of bits) for each cell, from the
+        ray_table(), with the cells which can turn the most pieces first.
+        Tables are built once per board size.
+
+        >>> BitBoard.reach_table(3, 1)
+        [(1, 4, [(2, 1)]), (1, 1, [(2, 4)]), (0, 2, [(1,), (4,)])]
+        '''
+        key = (width, height)
+        if key not in BitBoard._reach_tables:
+            table = []
+            for index, rays in enumerate(Board.ray_table(width, height)):
+                table.append((sum(len(ray) - 1 for ray in rays), 1 << index,
+                              [tuple(1 << i for i in ray) for ray in rays]))
+            table.sort(reverse=True)
+            BitBoard._reach_tables[key] = table
+        return BitBoard._reach_tables[key]
+
+    def state(self):
+        return {
+            'bits': (self.white, self.black),
+            'flip_count': dict(self.flip_count),
+            'place_history': self.place_history[:],
+            'size': (self.width, self.height),
+            'hashes': self.hashes[:],
+        }
+
+    def get(self, row, col):
+        bit = 1 << self._index(row, col)
+        if self.white & bit: return Board.WHITE
+        if self.black & bit: return Board.BLACK
+        return Board.EMPTY
+
+    def _get(self, index):
+        if self.white >> index & 1: return Board.WHITE
+        if self.black >> index & 1: return Board.BLACK
+        return Board.EMPTY
+
+    def cells(self):
+        return BitBoard.cells_of((self.white, self.black), self.width * self.height)
+
+    def count(self, color):
+        if color == Board.WHITE: return bin(self.white).count('1')
+        if color == Board.BLACK: return bin(self.black).count('1')
+        return self.width * self.height - bin(self.white | self.black).count('1')
+
+    def encode(self, weights):
+        encoded = 0
+        for color, mask in ((Board.WHITE, self.white), (Board.BLACK, self.black)):
+            while mask:
+                low = mask & -mask
+                encoded += color * weights[low.bit_length() - 1]
+                mask ^= low
+        return encoded
+
+    def reachable_flips(self, budget):
+        occupied = self.white | self.black
+        best = 0
+        for most, bit, rays in self.reaches:
+            # the rest of the cells cannot beat best
+            if most <= best: break
+            if occupied & bit: continue
+            flips = 0
+            for ray in rays:
+                left = budget
+                reach = 0
+                for b in ray:
+                    if not occupied & b:
+                        if not left: break
+                        left -= 1
+                    reach += 1
+                if reach > 1: flips += reach - 1
+            if flips > best: best = flips
+        return best
+
+    @staticmethod
+    def cells_of(bits, count):
+        '''
+        Colors of count cells ordered by index, from (white, black) masks.
+
+        >>> BitBoard.cells_of((0b0100, 0b0001), 4)
+        [2, 0, 1, 0]
+        '''
+        white, black = bits
+        return [Board.WHITE if white >> i & 1 else (Board.BLACK if black >> i & 1 else Board.EMPTY)
+                for i in range(count)]
+
+    def _set(self, index, color):
+        bit = 1 << index
+        self.white &= ~bit
+        self.black &= ~bit
+        if color == Board.WHITE: self.white |= bit
+        elif color == Board.BLACK: self.black |= bit
+
+    @staticmethod
+    def indices(mask):
+        '''
+        >>> BitBoard.indices(0b100110)
+        [1, 2, 5]
+        '''
+        indices = []
+        while mask:
+            low = mask & -mask
+            indices.append(low.bit_length() - 1)
+            mask ^= low
+        return indices
+
+    def flip(self, row, col):
+        assert self.get(row, col) != Board.EMPTY
+        index = self._index(row, col)
+        bit = 1 << index
+        if self.black & bit:
+            self.flip_count['BtoW'] += 1
+        else:
+            self.flip_count['WtoB'] += 1
+        self.white ^= bit
+        self.black ^= bit
+        self.hashes = map(operator.xor, self.hashes, self.normalizer.flip_keys[index])
+
+    def copy(self):
+        # skips building and reading a state, as next_states() copies every child
+        board = BitBoard.__new__(BitBoard)
+        board.width = self.width
+        board.height = self.height
+        board.white = self.white
+        board.black = self.black
+        board.flip_count = dict(self.flip_count)
+        board.place_history = self.place_history[:]
+        board.rays = self.rays
+        board.shifts = self.shifts
+        board.reaches = self.reaches
+        board.normalizer = self.normalizer
+        board.hashes = self.hashes[:]
+        return board
+
+    def place(self, row, col, color):
+        '''
+        The undo record keeps the flipped cells as a mask, and the hashes
+        from before, which unplace() restores instead of computing them.
+        '''
+        index = self._index(row, col)
+        bit = 1 << index
+        assert not (self.white | self.black) & bit
+        if color == Board.WHITE:
+            flips = self.flips(bit, self.white, self.black)
+            self.white |= bit | flips
+            self.black &= ~flips
+            self.flip_count['BtoW'] += bin(flips).count('1')
         else:
-            return []
+            flips = self.flips(bit, self.black, self.white)
+            self.black |= bit | flips
+            self.white &= ~flips
+            self.flip_count['WtoB'] += bin(flips).count('1')
+        hashes = self.hashes
+        delta = self.normalizer.piece_keys[color][index]
+        flip_keys = self.normalizer.flip_keys
+        turned = flips
+        while turned:
+            low = turned & -turned
+            delta = map(operator.xor, delta, flip_keys[low.bit_length() - 1])
+            turned ^= low
+        self.hashes = map(operator.xor, hashes, delta)
+        self.place_history.append((row, col, color))
+        return (row, col, color, flips, hashes)
+
+    def unplace(self, undo):
+        row, col, color, flips, hashes = undo
+        bit = 1 << self._index(row, col)
+        if color == Board.WHITE:
+            self.white &= ~(bit | flips)
+            self.black |= flips
+            self.flip_count['BtoW'] -= bin(flips).count('1')
+        else:
+            self.black &= ~(bit | flips)
+            self.white |= flips
+            self.flip_count['WtoB'] -= bin(flips).count('1')
+        self.hashes = hashes
+        self.place_history.pop()
+
+    def turnable(self, index, color):
+        bit = 1 << index
+        if color == Board.WHITE:
+            return BitBoard.indices(self.flips(bit, self.white, self.black))
+        return BitBoard.indices(self.flips(bit, self.black, self.white))
+
+    def flips(self, bit, own, opponent):
+        flips = 0
+        for distance, mask in self.shifts:
+            line = 0
+            if distance > 0:
+                x = (bit & mask) << distance
+                while x & opponent:
+                    line |= x
+                    x = (x & mask) << distance
+            else:
+                x = (bit & mask) >> -distance
+                while x & opponent:
+                    line |= x
+                    x = (x & mask) >> -distance
+            if x & own:
+                flips |= line
+        return flips
 
 
 class BoardNormalizer(object):
     '''
+    Makes integer ids of boards of one size.  An id packs 2 bits per cell
+    in row-major order, so comparing ids is comparing the boards cell by
+    cell.  Each symmetry is a permutation of cell indices which is built
+    once, and normalizers are shared per board size.
+
     >>> b = Board(width=3, height=3)
-    >>> b.place(0, 0, 1)
-    >>> b.place(0, 1, 2)
-    >>> b.place(0, 2, 2)
-    >>> BoardNormalizer.width = 3
-    >>> BoardNormalizer.height = 3
-    >>> BoardNormalizer.no_transform(b)
+    >>> _ = b.place(0, 0, 1)
+    >>> _ = b.place(0, 1, 2)
+    >>> _ = b.place(0, 2, 2)
+    >>> normalizer = BoardNormalizer.of(3, 3)
+    >>> normalizer.to_str(normalizer.no_transform(b))
     '122000000'
-    >>> BoardNormalizer.vertical_mirror(b)
+    >>> normalizer.to_str(normalizer.vertical_mirror(b))
     '221000000'
-    >>> BoardNormalizer.horizontal_mirror(b)
+    >>> normalizer.to_str(normalizer.horizontal_mirror(b))
     '000000122'
-    >>> BoardNormalizer.diagonal_mirror_left_up(b)
+    >>> normalizer.to_str(normalizer.diagonal_mirror_left_up(b))
     '100200200'
-    >>> BoardNormalizer.diagonal_mirror_right_up(b)
+    >>> normalizer.to_str(normalizer.diagonal_mirror_right_up(b))
     '002002001'
-    >>> BoardNormalizer.rotate_90(b)
+    >>> normalizer.to_str(normalizer.rotate_90(b))
     '001002002'
-    >>> BoardNormalizer.rotate_180(b)
+    >>> normalizer.to_str(normalizer.rotate_180(b))
     '000000221'
-    >>> BoardNormalizer.rotate_270(b)
+    >>> normalizer.to_str(normalizer.rotate_270(b))
     '200200100'
+    >>> normalizer.to_str(normalizer.normalize(b))
+    '000000122'
+    >>> BoardNormalizer.of(3, 3) is normalizer
+    True
+
+    Boards also carry one zobrist hash per symmetry, and the minimum of them
+    is the same for symmetric boards.
+
+    >>> b2 = Board(width=3, height=3)
+    >>> _ = b2.place(2, 2, 1)
+    >>> _ = b2.place(1, 2, 2)
+    >>> _ = b2.place(0, 2, 2)
+    >>> sorted(b2.hashes) == sorted(b.hashes)
+    True
+    >>> b2.hashes == normalizer.hashes(b2)
+    True
+    >>> undo = b2.place(0, 1, 1)
+    >>> b2.hashes == normalizer.hashes(b2)
+    True
+    >>> b2.unplace(undo)
+    >>> min(b2.hashes) == min(normalizer.hashes(b))
+    True
+
+    The symmetries of a size are the transforms which map its cells onto
+    themselves, so rectangles get the 180 degree rotation too.
+
+    >>> BoardNormalizer.of(3, 2).names
+    ['no_transform', 'vertical_mirror', 'horizontal_mirror', 'rotate_180']
+    >>> len(BoardNormalizer.of(4, 4).names)
+    8
     '''
 
-    @classmethod
-    def coords(cls):
+    # (name, function from (width, height, row, col) to the source cell)
+    TRANSFORMS = [
+        ('no_transform', lambda w, h, r, c: (r, c)),
+        ('vertical_mirror', lambda w, h, r, c: (r, w - c - 1)),
+        ('horizontal_mirror', lambda w, h, r, c: (h - r - 1, c)),
+        ('diagonal_mirror_left_up', lambda w, h, r, c: (c, r)),
+        ('diagonal_mirror_right_up', lambda w, h, r, c: (w - c - 1, h - r - 1)),
+        ('rotate_90', lambda w, h, r, c: (h - c - 1, r)),
+        ('rotate_180', lambda w, h, r, c: (h - r - 1, w - c - 1)),
+        ('rotate_270', lambda w, h, r, c: (c, w - r - 1)),
+    ]
+
+    _normalizers = {}
+
+    @staticmethod
+    def of(width, height):
+        key = (width, height)
         try:
-            return cls._coords
-        except AttributeError:
-            cls._coords = [(r, c) for r in range(cls.height) for c in range(cls.width)]
-            return cls._coords
+            return BoardNormalizer._normalizers[key]
+        except KeyError:
+            return BoardNormalizer._normalizers.setdefault(key, BoardNormalizer(width, height))
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        coords = [(r, c) for r in range(height) for c in range(width)]
+        self.names = []
+        self.weights = {}
+        self.symmetries = []
+        # images[s][i] is the cell index where cell index i goes under symmetry s
+        self.images = []
+        # positions[i] lists where cell index i goes under each symmetry
+        positions = [[] for _ in coords]
+        for name, source in BoardNormalizer.TRANSFORMS:
+            sources = [source(width, height, r, c) for (r, c) in coords]
+            if set(sources) != set(coords): continue
+            # weights[i] is the value of a piece of color 1 on cell index i
+            weights = [0] * len(coords)
+            for k, (sr, sc) in enumerate(sources):
+                weights[sr + sc * height] = 4 ** (len(coords) - k - 1)
+                positions[sr + sc * height].append(k)
+            self.names.append(name)
+            self.weights[name] = weights
+            self.symmetries.append(weights)
+            images = [0] * len(coords)
+            for k, (sr, sc) in enumerate(sources):
+                r, c = coords[k]
+                images[sr + sc * height] = r + c * height
+            self.images.append(images)
+
+        # the seed only depends on the size, so every process agrees on hashes
+        rng = random.Random(width * 1000 + height)
+        zobrist = [None] + [[int(rng.getrandbits(63)) for _ in coords] for color in (Board.WHITE, Board.BLACK)]
+        self.piece_keys = [None] + [
+            [tuple(zobrist[color][k] for k in positions[i]) for i in range(len(coords))]
+            for color in (Board.WHITE, Board.BLACK)]
+        self.flip_keys = [map(operator.xor, w, b) for w, b in zip(self.piece_keys[Board.WHITE], self.piece_keys[Board.BLACK])]
+
+    def hashes(self, board):
+        hashes = [0] * len(self.symmetries)
+        for i, color in enumerate(board.cells()):
+            if color != Board.EMPTY:
+                hashes = map(operator.xor, hashes, self.piece_keys[color][i])
+        return hashes
+
+    def stabilizer(self, board):
+        '''
+        Returns images of the symmetries, other than no_transform, which
+        leave the board as it is.  Hashes rule out most symmetries and the
+        rest are checked exactly.
+
+        >>> normalizer = BoardNormalizer.of(3, 3)
+        >>> len(normalizer.stabilizer(Board(width=3, height=3)))
+        7
+        >>> b = Board(width=3, height=3)
+        >>> _ = b.place(0, 0, Board.WHITE)
+        >>> [normalizer.names[normalizer.images.index(images)] for images in normalizer.stabilizer(b)]
+        ['diagonal_mirror_left_up']
+        >>> _ = b.place(2, 1, Board.BLACK)
+        >>> normalizer.stabilizer(b)
+        []
+        '''
+        hashes = board.hashes
+        identity = None
+        stabilizer = []
+        for s in range(1, len(self.symmetries)):
+            if hashes[s] != hashes[0]: continue
+            if identity is None:
+                identity = self.encode(board, self.symmetries[0])
+            if self.encode(board, self.symmetries[s]) == identity:
+                stabilizer.append(self.images[s])
+        return stabilizer
 
-    @classmethod
-    def str(cls, l):
-        return ''.join([str(i) for i in l])
+    def hash_delta(self, index, color, turned):
+        delta = self.piece_keys[color][index]
+        for i in turned:
+            delta = map(operator.xor, delta, self.flip_keys[i])
+        return delta
 
-    @classmethod
-    def no_transform(cls, board):
-        return cls.str([str(board.get(r, c)) for (r, c) in cls.coords()])
+    def encode(self, board, weights):
+        return board.encode(weights)
 
-    @classmethod
-    def vertical_mirror(cls, board):
-        return cls.str([str(board.get(r, cls.width - c - 1)) for (r, c) in cls.coords()])
+    def normalize(self, board):
+        return min(board.encode(weights) for weights in self.symmetries)
 
-    @classmethod
-    def horizontal_mirror(cls, board):
-        return cls.str([str(board.get(cls.height - r - 1, c)) for (r, c) in cls.coords()])
+    def to_str(self, normalized_id):
+        digits = []
+        for i in range(self.width * self.height):
+            digits.append(str(normalized_id & 3))
+            normalized_id >>= 2
+        return ''.join(reversed(digits))
 
-    @classmethod
-    def diagonal_mirror_left_up(cls, board):
-        return cls.str([str(board.get(c, r)) for (r, c) in cls.coords()])
+    def no_transform(self, board):
+        return self.encode(board, self.weights['no_transform'])
 
-    @classmethod
-    def diagonal_mirror_right_up(cls, board):
-        return cls.str([str(board.get(cls.width - c - 1, cls.height - r - 1)) for (r, c) in cls.coords()])
+    def vertical_mirror(self, board):
+        return self.encode(board, self.weights['vertical_mirror'])
 
-    @classmethod
-    def rotate_90(cls, board):
-        return cls.str([str(board.get(cls.height - c - 1, r)) for (r, c) in cls.coords()])
+    def horizontal_mirror(self, board):
+        return self.encode(board, self.weights['horizontal_mirror'])
 
-    @classmethod
-    def rotate_180(cls, board):
-        return cls.str([str(board.get(cls.height - r - 1, cls.width - c - 1)) for (r, c) in cls.coords()])
+    def diagonal_mirror_left_up(self, board):
+        return self.encode(board, self.weights['diagonal_mirror_left_up'])
 
-    @classmethod
-    def rotate_270(cls, board):
-        return cls.str([str(board.get(c, cls.width - r - 1)) for (r, c) in cls.coords()])
+    def diagonal_mirror_right_up(self, board):
+        return self.encode(board, self.weights['diagonal_mirror_right_up'])
+
+    def rotate_90(self, board):
+        return self.encode(board, self.weights['rotate_90'])
+
+    def rotate_180(self, board):
+        return self.encode(board, self.weights['rotate_180'])
+
+    def rotate_270(self, board):
+        return self.encode(board, self.weights['rotate_270'])
+
+
+class CollisionCheck(object):
+    '''
+    Keeps the exact id of the position first seen under each hashed id.  A
+    different position with the same hash gets -1 - its exact id instead,
+    which no hash can be, as hashes are non-negative.  A position gets the
+    same id every time it is checked.  Candidates pickle a token of their
+    check, so that those spilled and read back in the same process keep it.
+    Checks are locked, as BigHeap's prefetching thread decodes candidates
+    too.
+
+    >>> check = CollisionCheck()
+    >>> check.checked(5, 100), check.checked(5, 101), check.checked(5, 100), check.checked(5, 101)
+    (5, -102, 5, -102)
+    >>> check.collisions
+    2
+    '''
+    _checks = weakref.WeakValueDictionary()
+    _tokens = itertools.count()
+
+    def __init__(self):
+        self.exact_ids = {}
+        self.collisions = 0
+        self._lock = threading.Lock()
+        self.token = (os.getpid(), next(CollisionCheck._tokens))
+        CollisionCheck._checks[self.token] = self
+
+    @staticmethod
+    def of(token):
+        return CollisionCheck._checks.get(token) if token else None
+
+    def checked(self, hashed_id, exact_id):
+        with self._lock:
+            known = self.exact_ids.setdefault(hashed_id, exact_id)
+            if known == exact_id: return hashed_id
+            self.collisions += 1
+        return -1 - exact_id
 
 
 class OthelloCandidate(object):
-    def __init__(self, place_limit, board):
+    '''
+    By default normalized ids are the smallest of the symmetric hashes kept
+    by the board.  Pass a CollisionCheck as check to compare the exact ids
+    of positions whose hashes match, or exact=True to use exact ids from
+    BoardNormalizer instead of hashes.  Either never confuses positions but
+    costs O(cells) per candidate.  Candidates unpickled in another process
+    are not checked.
+
+    >>> board = Board(width=3, height=3)
+    >>> _ = board.place(0, 0, Board.WHITE)
+    >>> c = OthelloCandidate(2, board)
+    >>> c._normalized_id == min(board.hashes)
+    True
+    >>> c = OthelloCandidate(2, board, exact=True)
+    >>> BoardNormalizer.of(3, 3).to_str(c._normalized_id)
+    '000000001'
+    >>> [BoardNormalizer.of(3, 3).to_str(child._normalized_id) for child in c.next_states()][:2]
+    ['000000011', '000000021']
+    >>> check = CollisionCheck()
+    >>> c = OthelloCandidate(2, board, check=check)
+    >>> c._normalized_id == min(board.hashes), len(list(c.next_states())), len(check.exact_ids)
+    (True, 10, 11)
+
+    Children get their distance_sum from the parent's one and the placed
+    cell, and it equals the sum computed from scratch.
+
+    >>> board = Board.build((
+    ...   'W...',
+    ...   '....',
+    ...   '..B.',
+    ...   '...B',
+    ... ))
+    >>> c = OthelloCandidate(4, board)
+    >>> c.distance_sum()
+    8
+    >>> all(child.distance_sum() == OthelloCandidate.pieces_distance_sum(child.board) for child in c.next_states())
+    True
+    '''
+    __slots__ = ['place_limit', 'board', 'exact', 'check', '_normalized_id', '_distance_sum', '_upper_bound']
+
+    def __init__(self, place_limit, board, normalized_id=None, exact=False, distance_sum=None, check=None):
         self.place_limit = place_limit
         self.board = board
-        self._normalized_id = self.normalized_id()
+        self.exact = exact
+        self.check = None if exact else check
+        if normalized_id is None:
+            normalized_id = self.normalized_id()
+        self._normalized_id = normalized_id
+        if distance_sum is None:
+            distance_sum = OthelloCandidate.pieces_distance_sum(board)
+        self._distance_sum = distance_sum
+        self._upper_bound = None
+
+    def __getstate__(self):
+        token = self.check.token if self.check else None
+        return (self.place_limit, self.board, self.exact, self._normalized_id, self._distance_sum, token)
+
+    def __setstate__(self, state):
+        self.place_limit, self.board, self.exact, self._normalized_id, self._distance_sum, token = state
+        self.check = CollisionCheck.of(token)
+        self._upper_bound = None
 
-    def distance_sum(self):
-        if '_distance_sum' in dir(self):
-            return self._distance_sum
-        pieces = [(r, c) for r in range(self.board.height) for c in range(self.board.width) if self.board.get(r, c) != Board.EMPTY]
-        if not pieces: return 0
-        sum = 0
+    @staticmethod
+    def pieces(board):
+        return [(r, c) for r in range(board.height) for c in range(board.width) if board.get(r, c) != Board.EMPTY]
+
+    @staticmethod
+    def nearest_distances(pieces):
+        '''
+        Returns ((row, col), distance to the nearest other piece) for every
+        piece.  The distance is None for a lone piece.
+        '''
+        nearest = []
         for row, col in pieces:
             distances = [abs(row - r) + abs(col - c) for (r, c) in pieces if not (row == r and col == c)]
-            sum += min(distances) if distances else 0
-        #return (sum + 0.0) / (len(pieces) ** 2)
-        self._distance_sum = sum
-        return sum
+            nearest.append(((row, col), min(distances) if distances else None))
+        return nearest
+
+    @staticmethod
+    def pieces_distance_sum(board):
+        nearest = OthelloCandidate.nearest_distances(OthelloCandidate.pieces(board))
+        return sum(d for _, d in nearest if d is not None)
+
+    @staticmethod
+    def placed_distance_sum(nearest, distance_sum, row, col):
+        '''
+        distance_sum after a piece is placed at (row, col), given the
+        nearest_distances() and distance_sum before the placement.
+        '''
+        own = None
+        for (r, c), d in nearest:
+            distance = abs(row - r) + abs(col - c)
+            if own is None or distance < own: own = distance
+            if d is None: distance_sum += distance
+            elif distance < d: distance_sum += distance - d
+        return distance_sum + (own or 0)
+
+    def distance_sum(self):
+        return self._distance_sum
+
+    def priority(self):
+        return -self._distance_sum
 
     def normalized_id(self):
-        BoardNormalizer.width = self.board.width
-        BoardNormalizer.height = self.board.height
-        
-        coords = [(r, c) for r in range(self.board.height) for c in range(self.board.width)]
-
-        patterns = [
-            BoardNormalizer.no_transform(self.board),
-            BoardNormalizer.vertical_mirror(self.board),
-            BoardNormalizer.horizontal_mirror(self.board),
-        ]
-        if self.board.width == self.board.height:
-            patterns += [
-                BoardNormalizer.diagonal_mirror_left_up(self.board),
-                BoardNormalizer.diagonal_mirror_right_up(self.board),
-                BoardNormalizer.rotate_90(self.board),
-                BoardNormalizer.rotate_180(self.board),
-                BoardNormalizer.rotate_270(self.board),
-            ]
-        return ''.join((str(c) for c in min(patterns)))
+        if self.exact:
+            return self.board.normalizer.normalize(self.board)
+        if self.check:
+            return self.check.checked(min(self.board.hashes), self.board.normalizer.normalize(self.board))
+        return min(self.board.hashes)
 
     def is_final(self):
         return len(self.board.place_history) >= self.place_limit
@@ -360,15 +1124,122 @@ class OthelloCandidate(object):
     def score(self):
         return self.board.flip_count['WtoB']
 
-    def next_states(self):
-        for r in range(self.board.height):
-            for c in range(self.board.width):
-                if self.board.get(r, c) != Board.EMPTY: continue
-                for color in [Board.WHITE, Board.BLACK]:
-                    next_board = Board(self.board.state())
-                    next_board.place(r, c, color)
-                    yield OthelloCandidate(self.place_limit, next_board)
+    def remaining(self):
+        return self.place_limit - len(self.board.place_history)
+
+    def upper_bound(self):
+        '''
+        No descendant can score more than this.  It is computed once, as
+        Search checks it when the candidate is pushed and again when it is
+        popped.
+
+        >>> [OthelloCandidate(limit, Board(width=4, height=4)).upper_bound() for limit in range(1, 7)]
+        [0, 0, 1, 2, 3, 5]
+        >>> board = Board(width=4, height=4)
+        >>> _ = board.place(0, 0, Board.BLACK)
+        >>> _ = board.place(0, 1, Board.WHITE)
+        >>> _ = board.place(0, 2, Board.BLACK)
+        >>> c = OthelloCandidate(4, board)
+        >>> c.score(), c.upper_bound()
+        (1, 1)
+        >>> OthelloCandidate(5, board).upper_bound()
+        2
+        '''
+        if self._upper_bound is None:
+            board = self.board
+            placements = self.remaining()
+            bound = self.score()
+            if placements > 0:
+                bound += OthelloCandidate.future_flips(
+                    board.count(Board.WHITE), board.count(Board.BLACK), placements,
+                    board.reachable_flips(placements - 1))
+            self._upper_bound = bound
+        return self._upper_bound
+
+    _future_flips = {}
 
+    @staticmethod
+    def future_flips(whites, blacks, placements, max_flips):
+        '''
+        Most WtoB flips that the placements can make, only knowing how many
+        pieces of each color there are.  A placement turns at most max_flips
+        pieces of the other color, and only when a piece of its own color is
+        left on the board to sandwich them.  upper_bound() passes the
+        reachable_flips() of the board for the placements to come.
+        '''
+        if placements <= 0: return 0
+        key = (whites, blacks, placements, max_flips)
+        cache = OthelloCandidate._future_flips
+        if key not in cache:
+            best = 0
+            for flips in range(min(max_flips, blacks) + 1 if whites else 1):
+                best = max(best, OthelloCandidate.future_flips(whites + 1 + flips, blacks - flips, placements - 1, max_flips))
+            for flips in range(min(max_flips, whites) + 1 if blacks else 1):
+                best = max(best, flips + OthelloCandidate.future_flips(whites - flips, blacks + 1 + flips, placements - 1, max_flips))
+            cache[key] = best
+        return cache[key]
+
+    def next_states(self, is_processed=None):
+        '''
+        Children are made by place()/unplace() on this candidate's own board,
+        and only copied when they pass is_processed(normalized_id, score).
+        When the board is symmetric, only one cell of each orbit under its
+        symmetries is tried, since the others give symmetric children.
+        While a child is being yielded this candidate's board holds the
+        child's move, so do not read it until the iteration is over.
+
+        >>> start = OthelloCandidate(2, Board(width=3, height=3))
+        >>> for child in start.next_states():
+        ...     print child.dump(history=True)
+        ('W..',
+         '...',
+         '...')(0, 0, 1)
+        ('B..',
+         '...',
+         '...')(0, 0, 2)
+        ('...',
+         'W..',
+         '...')(1, 0, 1)
+        ('...',
+         'B..',
+         '...')(1, 0, 2)
+        ('...',
+         '.W.',
+         '...')(1, 1, 1)
+        ('...',
+         '.B.',
+         '...')(1, 1, 2)
+        >>> len(list(start.next_states(lambda normalized_id, score: True)))
+        0
+        >>> print start.dump(history=True)
+        ('...',
+         '...',
+         '...')
+        '''
+        board = self.board
+        exact = self.exact
+        check = self.check
+        stabilizer = board.normalizer.stabilizer(board)
+        nearest = None
+        for r in range(board.height):
+            for c in range(board.width):
+                if board.get(r, c) != Board.EMPTY: continue
+                index = board._index(r, c)
+                if any(images[index] < index for images in stabilizer): continue
+                for color in [Board.WHITE, Board.BLACK]:
+                    undo = board.place(r, c, color)
+                    try:
+                        normalized_id = board.normalizer.normalize(board) if exact else min(board.hashes)
+                        if check: normalized_id = check.checked(normalized_id, board.normalizer.normalize(board))
+                        if is_processed and is_processed(normalized_id, board.flip_count['WtoB']): continue
+                        if nearest is None:
+                            # flips do not move pieces, so the parent's pieces are the ones besides (r, c)
+                            pieces = [p for p in OthelloCandidate.pieces(board) if p != (r, c)]
+                            nearest = OthelloCandidate.nearest_distances(pieces)
+                        distance_sum = OthelloCandidate.placed_distance_sum(nearest, self._distance_sum, r, c)
+                        yield OthelloCandidate(self.place_limit, board.copy(), normalized_id, exact, distance_sum, check)
+                    finally:
+                        board.unplace(undo)
 
     def dump(self, **argv):
         return self.board.dump(**argv)
@@ -377,7 +1248,129 @@ class OthelloCandidate(object):
         return hash(self._normalized_id)
 
     def __cmp__(self, other):
-        return -cmp(self.distance_sum(), other.distance_sum())
+        return cmp(other._distance_sum, self._distance_sum)
+
+
+class CandidateCodec(object):
+    '''
+    Packs OthelloCandidates of one board size and place limit into records
+    of a fixed size: the history length, flip counts and distance_sum, the
+    cells at 2 bits each, the history as one index * 4 + color per
+    placement, and the hashes of the board.  Exact ids are packed as well;
+    hashed ids are min(hashes) and are not stored.
+
+    >>> codec = CandidateCodec(4, 4, 6)
+    >>> codec.size
+    89
+    >>> board = Board.build(('W...', '.B..', '..WB', '....'))
+    >>> _ = board.place(0, 1, Board.BLACK)
+    >>> c = OthelloCandidate(6, board)
+    >>> data = codec.encode(c)
+    >>> len(data)
+    89
+    >>> d = codec.decode(data)
+    >>> print d.dump(history=True)
+    ('WB..',
+     '.B..',
+     '..WB',
+     '....')(0, 1, 2)
+    >>> (d._normalized_id, d.distance_sum(), d.score(), d.board.hashes) == (c._normalized_id, c.distance_sum(), c.score(), c.board.hashes)
+    True
+    >>> codec = CandidateCodec(4, 4, 6, board_class=BitBoard, exact=True)
+    >>> c = OthelloCandidate(6, BitBoard(board.state()), exact=True)
+    >>> d = codec.decode(codec.encode(c))
+    >>> d.board.__class__.__name__, d._normalized_id == c._normalized_id
+    ('BitBoard', True)
+    '''
+    def __init__(self, width, height, place_limit, board_class=Board, exact=False, check=None):
+        self.width = width
+        self.height = height
+        self.place_limit = place_limit
+        self.board_class = board_class
+        self.exact = exact
+        self.check = check
+
+        cells = width * height
+        self.cell_weights = [4 ** i for i in range(cells)]
+        self.cell_bytes = (cells * 2 + 7) // 8
+        symmetries = len(BoardNormalizer.of(width, height).symmetries)
+        fmt = '<BHHI%ds%dH%dQ'%(self.cell_bytes, place_limit, symmetries)
+        if exact: fmt += '%ds'%(self.cell_bytes)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    @staticmethod
+    def of(candidate):
+        '''
+        A codec for candidates like the given one.
+        '''
+        board = candidate.board
+        return CandidateCodec(board.width, board.height, candidate.place_limit, board.__class__, candidate.exact, candidate.check)
+
+    def __getstate__(self):
+        return (self.width, self.height, self.place_limit, self.board_class, self.exact)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def pack_int(self, value):
+        return ('%0*x'%(self.cell_bytes * 2, value)).decode('hex')
+
+    def unpack_int(self, data):
+        return int(data.encode('hex'), 16)
+
+    def encode(self, candidate):
+        board = candidate.board
+        history = [(r + c * self.height) * 4 + color for r, c, color in board.place_history]
+        history += [0] * (self.place_limit - len(history))
+        values = [len(board.place_history), board.flip_count['BtoW'], board.flip_count['WtoB'],
+                  candidate._distance_sum,
+                  self.pack_int(board.encode(self.cell_weights))]
+        values += history + list(board.hashes)
+        if self.exact: values.append(self.pack_int(candidate._normalized_id))
+        return self.struct.pack(*values)
+
+    def decode(self, data, offset=0):
+        values = self.struct.unpack_from(data, offset)
+        placed, b_to_w, w_to_b, distance_sum, packed = values[:5]
+        packed = self.unpack_int(packed)
+        cells = self.width * self.height
+        history = [(h // 4 % self.height, h // 4 // self.height, h % 4) for h in values[5:5 + placed]]
+        state = {
+            'board': [(packed >> (2 * i)) & 3 for i in range(cells)],
+            'flip_count': {'BtoW': b_to_w, 'WtoB': w_to_b},
+            'place_history': history,
+            'size': (self.width, self.height),
+        }
+        if self.exact:
+            state['hashes'] = list(values[5 + self.place_limit:-1])
+            normalized_id = self.unpack_int(values[-1])
+        else:
+            state['hashes'] = list(values[5 + self.place_limit:])
+            normalized_id = None if self.check else min(state['hashes'])
+        return OthelloCandidate(self.place_limit, self.board_class(state), normalized_id, self.exact, distance_sum, self.check)
+
+
+BOARDS = {
+    'list': Board,
+    'bit': BitBoard,
+}
+
+def create_board(args):
+    return BOARDS[args.board](width=args.width, height=args.height)
+
+
+def heap_bytes(args):
+    return args.heap_mb * 1024 * 1024 if args.heap_mb else None
+
+
+def create_flavor(args, codec, **options):
+    options.update(codec=codec, prefetch=args.prefetch, max_bytes=heap_bytes(args))
+    if args.processed_limit:
+        return SpillingProcessedFlavor(args.processed_limit, **options)
+    if args.compact_processed:
+        return CompactProcessedFlavor(**options)
+    return BigHeapFlavor(**options)
 
 
 def parse_args():
@@ -387,12 +1380,36 @@ def parse_args():
     parser.add_argument('-m', '--mode', type=str, default='single')
     parser.add_argument('-d', '--depth', type=int, default=3)
     parser.add_argument('-s', '--size', type=int, default=3)
-    parser.add_argument('-b', '--batchsize', type=int, default=2)
+    parser.add_argument('-b', '--batchsize', type=int, help='candidates per batch; 64 in partitioned and stealing modes, 2 otherwise')
     parser.add_argument('-c', '--concurrency', type=int, default=1)
     parser.add_argument('--width', type=int)
     parser.add_argument('--height', type=int)
+    parser.add_argument('--board', type=str, default='list', choices=sorted(BOARDS.keys()))
+    parser.add_argument('--exact-ids', action='store_true', help='use exact normalized ids instead of symmetric hashes')
+    parser.add_argument('--check-collisions', action='store_true', help='compare exact ids of positions whose hashes match, in single mode')
+    parser.add_argument('--packed', action='store_true', help='spill and transmit candidates as packed records instead of pickles')
+    parser.add_argument('--heap-mb', type=int, help='memory budget of the candidates heap, instead of item counts')
+    parser.add_argument('--compact-processed', action='store_true', help='keep processed ids in typed arrays instead of a dict, for ids of at most 63 bits')
+    parser.add_argument('--processed-limit', type=int, help='processed ids kept on memory before spilling them to disk')
+    parser.add_argument('--filter-capacity', type=int, default=1 << 22, help='ids the bloom filter in front of shared processed ids is sized for; 0 disables it')
+    parser.add_argument('--filter-error-rate', type=float, default=0.01)
+    parser.add_argument('--shared-processed', type=int, default=0, help='capacity of a processed table in shared memory for multiprocessing and stealing modes')
+    parser.add_argument('--prefetch', action='store_true', help='read the next spilled fragment in background')
+    parser.add_argument('--latency', action='store_true', help='print percentiles of candidate pop latencies')
+    parser.add_argument('--pipeline-batch', type=int, default=512, help='candidates popped per round in pipeline mode')
+    parser.add_argument('--chunk-size', type=int, default=32, help='candidates per task of the pool in pipeline mode')
+    parser.add_argument('--run-size', type=int, default=100000, help='candidates kept in memory per sorted run in layered mode')
 
     args = parser.parse_args()
+    if args.check_collisions and args.mode != 'single':
+        # the check is kept per process and not pickled with candidates
+        parser.error('--check-collisions is only supported in single mode')
+    if args.compact_processed and args.exact_ids and (args.width or args.size) * (args.height or args.size) * 2 > 63:
+        # exact ids take 2 bits per cell, and would all go to the table's overflow dict
+        parser.error('--compact-processed needs hashed ids, or exact ids of at most 31 cells')
+    if args.batchsize is None:
+        # these modes send a message per batch, so small batches are mostly transport
+        args.batchsize = 64 if args.mode in ('partitioned', 'stealing') else 2
     if not args.width: args.width = args.size
     if not args.height: args.height = args.size
     return args
@@ -401,28 +1418,37 @@ def parse_args():
 def run_server(args):
     import sys
     sys.argv[1] = '' # bypass ip arg in web/wsgi.py
-    search = Search(dump=True)
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    codec = CandidateCodec.of(start) if args.packed else None
+    search = Search(dump=True, flavor=create_flavor(args, codec))
     search.start_dumper()
 
-    start = OthelloCandidate(args.depth, Board(width=args.width, height=args.height))
     search.add_candiates(start.next_states())
     for candidate in search.candidates():
         search.process_candidate(candidate)
         if len(search.candidates_list) > args.concurrency * args.batchsize: break
 
     import search_server
-    search_server.SearchServer.run(search)
+    search_server.SearchServer.run(search, codec)
+
+
+def search_and_report(search):
+    search.search_single()
+    # after an error this worker would otherwise look busy to the others forever
+    search.candidates_list.release()
+    if hasattr(search._processed, 'stats'):
+        print 'worker %d processed lookups: %s'%(os.getpid(), search._processed.stats())
 
 
 def run_by_multiprocessing(args):
     import datetime
     started = datetime.datetime.now()
     import multiprocessing
-    flavor = MultiprocessingFlavor()
+    flavor = MultiprocessingFlavor(args.filter_capacity, args.filter_error_rate, args.shared_processed)
     search = Search(dump=False, flavor=flavor)
     search.start_dumper()
 
-    start = OthelloCandidate(args.depth, Board(width=args.width, height=args.height))
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
     search.add_candiates(start.next_states())
     for candidate in search.candidates():
         search.process_candidate(candidate)
@@ -430,7 +1456,7 @@ def run_by_multiprocessing(args):
 
     processes = []
     for i in range(args.concurrency):
-        p = multiprocessing.Process(target=search.search_single)
+        p = multiprocessing.Process(target=search_and_report, args=(search,))
         p.start()
         processes.append(p)
 
@@ -441,20 +1467,97 @@ def run_by_multiprocessing(args):
         print b.board.dump(history=True)
 
 
+def run_partitioned(args):
+    import datetime
+    from agiletreasurehuntgame.partitioned import PartitionedSearch
+    started = datetime.datetime.now()
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    codec = CandidateCodec.of(start) if args.packed else None
+    search = PartitionedSearch(workers=args.concurrency, batch_size=args.batchsize, codec=codec)
+    best_score = search.search(start)
+    print 'Finished! elapsed: %s'%(datetime.datetime.now() - started)
+    for i, (processed, expanded) in enumerate(search.worker_stats):
+        print 'worker %d: processed:%d, expanded:%d'%(i, processed, expanded)
+    for b in search.final_bests():
+        print 'score=%d'%(best_score)
+        print b.board.dump(history=True)
+
+
+def run_stealing(args):
+    import datetime
+    from agiletreasurehuntgame.stealing import StealingSearch
+    started = datetime.datetime.now()
+    search = StealingSearch(workers=args.concurrency, batch_size=args.batchsize, capacity=args.shared_processed or 1 << 20)
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    best_score = search.search(start)
+    print 'Finished! elapsed: %s, processed: %d'%(datetime.datetime.now() - started, search.processed)
+    for i, (expanded, steals, robbed) in enumerate(search.worker_stats):
+        print 'worker %d: expanded:%d, batches stolen:%d, stolen from it:%d'%(i, expanded, steals, robbed)
+    for b in search.final_bests():
+        print 'score=%d'%(best_score)
+        print b.board.dump(history=True)
+
+
+def run_pipeline(args):
+    import datetime
+    from agiletreasurehuntgame.pipeline import PipelineSearch
+    started = datetime.datetime.now()
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    codec = CandidateCodec.of(start)
+    search = PipelineSearch(codec, processes=args.concurrency, batch_size=args.pipeline_batch, chunk_size=args.chunk_size,
+                            dump=True, flavor=create_flavor(args, codec if args.packed else None))
+    search.search(start)
+    print 'elapsed: %s, batches: %d'%(datetime.datetime.now() - started, search.batches)
+    for b in search.final_bests():
+        print 'score=%d'%(b.score())
+        print b.board.dump(history=True)
+
+
 def run_single(args):
     import datetime
     started = datetime.datetime.now()
-    search = Search(dump=True)
+    check = CollisionCheck() if args.check_collisions else None
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids, check=check)
+    codec = CandidateCodec.of(start) if args.packed else None
+    search = Search(dump=True, flavor=create_flavor(args, codec, measure=args.latency))
 #    search = SearchWithGenerator()
-    start = OthelloCandidate(args.depth, Board(width=args.width, height=args.height))
     search.add_candiates(start.next_states())
     search.search_single()
     print 'elapsed: %s'%(datetime.datetime.now() - started)
-    for b in search.final_bests:
+    if check:
+        print 'hash collisions: %d'%(check.collisions)
+    if args.latency:
+        for p, latency in sorted(search.candidates_list.latency_percentiles().items()):
+            print 'pop latency p%s: %.3fms'%(p, latency * 1000)
+    for b in search.final_bests():
         print 'score=%d'%(b.score())
         print b.board.dump(history=True)
 
 
+def run_dp(args):
+    import datetime
+    started = datetime.datetime.now()
+    search = DynamicProgrammingSearch()
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    best_score = search.search(start)
+    print 'elapsed: %s, states: %d'%(datetime.datetime.now() - started, len(search._values))
+    for b in search.final_bests():
+        print 'score=%d'%(best_score)
+        print b.board.dump(history=True)
+
+
+def run_layered(args):
+    import datetime
+    started = datetime.datetime.now()
+    search = LayeredSearch(dump=True, run_size=args.run_size)
+    start = OthelloCandidate(args.depth, create_board(args), exact=args.exact_ids)
+    best_score = search.search(start)
+    print 'elapsed: %s'%(datetime.datetime.now() - started)
+    for b in search.final_bests():
+        print 'score=%d'%(best_score)
+        print b.board.dump(history=True)
+
+
 def main():
     args = parse_args()
     if args.mode == 'http':
@@ -463,9 +1566,22 @@ def main():
         run_by_multiprocessing(args)
     elif args.mode == 'single':
         run_single(args)
+    elif args.mode == 'dp':
+        run_dp(args)
+    elif args.mode == 'layered':
+        run_layered(args)
+    elif args.mode == 'partitioned':
+        run_partitioned(args)
+    elif args.mode == 'stealing':
+        run_stealing(args)
+    elif args.mode == 'pipeline':
+        run_pipeline(args)
     else:
         run_single(args)
 
 if __name__=='__main__':
-    main()
+    # run from the imported module, so that pickled candidates refer to
+    # agiletreasurehuntgame.othello rather than __main__
+    from agiletreasurehuntgame import othello
+    othello.main()
 
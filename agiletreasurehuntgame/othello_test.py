@@ -0,0 +1,304 @@
+# coding: utf-8
+
+import unittest
+from hamcrest import *
+
+from othello import Board, BitBoard, BoardNormalizer, OthelloCandidate, CandidateCodec, CollisionCheck
+from bigheap import BigHeap
+import search_server
+from search import Search, ComparableCandidatesFlavor, DynamicProgrammingSearch, LayeredSearch
+
+
+def rows_of(board):
+    return tuple(''.join(Board.CHARS[board.get(r, c)] for c in range(board.width)) for r in range(board.height))
+
+def brute_force_canonical(rows):
+    '''
+    The smallest of all mirrored, rotated and transposed images of rows
+    which keep the shape of the board.
+    '''
+    images = []
+    for grid in (rows, tuple(''.join(col) for col in zip(*rows))):
+        for flipped_rows in (grid, grid[::-1]):
+            for image in (flipped_rows, tuple(row[::-1] for row in flipped_rows)):
+                if len(image) == len(rows) and len(image[0]) == len(rows[0]):
+                    images.append(image)
+    return min(images)
+
+def reachable_boards(width, height, limit, board_class=Board):
+    '''
+    Every board reachable with 1 to limit placements, one per distinct layout.
+    '''
+    layer = [board_class(width=width, height=height)]
+    boards = []
+    for depth in range(limit):
+        next_layer = {}
+        for board in layer:
+            for r in range(height):
+                for c in range(width):
+                    if board.get(r, c) != Board.EMPTY: continue
+                    for color in [Board.WHITE, Board.BLACK]:
+                        undo = board.place(r, c, color)
+                        rows = rows_of(board)
+                        if rows not in next_layer:
+                            next_layer[rows] = board.copy()
+                        board.unplace(undo)
+        layer = next_layer.values()
+        boards += layer
+    return boards
+
+def assert_same_bests_as_search(driver, cases=[(3, 3, 4), (4, 3, 4), (4, 4, 4)], board_class=Board):
+    '''
+    For each (width, height, limit) of cases, runs driver(start).search(start)
+    from an empty board and checks that it finds the best score and bests
+    of a plain Search.
+    '''
+    for width, height, limit in cases:
+        start = OthelloCandidate(limit, board_class(width=width, height=height))
+        search = Search()
+        search.add_candiates(start.next_states())
+        search.search_single()
+
+        searched = driver(start)
+        best_score = searched.search(start)
+
+        assert_that(best_score, is_(search.best_score))
+        assert_that(set(b.normalized_id() for b in searched.final_bests()),
+                    is_(set(b.normalized_id() for b in search.final_bests())))
+        for b in searched.final_bests():
+            assert_that(b.score(), is_(best_score))
+            assert_that(len(b.board.place_history), is_(limit))
+
+
+class BitBoardTest(unittest.TestCase):
+    def assert_same_boards(self, actual, expected):
+        assert_that(rows_of(actual), is_(rows_of(expected)))
+        assert_that(actual.flip_count, is_(expected.flip_count))
+        assert_that(actual.place_history, is_(expected.place_history))
+        assert_that(actual.hashes, is_(expected.hashes))
+
+    def test_states_round_trip_between_backends(self):
+        for board in reachable_boards(4, 3, 4):
+            bit_board = BitBoard(board.state())
+            self.assert_same_boards(bit_board, board)
+            self.assert_same_boards(Board(bit_board.state()), board)
+
+    def test_reads_like_board(self):
+        for board in reachable_boards(4, 3, 4):
+            bit_board = BitBoard(board.state())
+            for r in range(board.height):
+                for c in range(board.width):
+                    for v in Board.VECTORS:
+                        assert_that(bit_board.get_line(r, c, v), is_(board.get_line(r, c, v)))
+                    if board.get(r, c) != Board.EMPTY: continue
+                    index = board._index(r, c)
+                    for color in [Board.WHITE, Board.BLACK]:
+                        assert_that(sorted(bit_board.turnable(index, color)), is_(sorted(board.turnable(index, color))))
+            for color in [Board.EMPTY, Board.WHITE, Board.BLACK]:
+                assert_that(bit_board.count(color), is_(board.count(color)))
+            for budget in range(4):
+                assert_that(bit_board.reachable_flips(budget), is_(board.reachable_flips(budget)))
+            normalizer = board.normalizer
+            assert_that(normalizer.normalize(bit_board), is_(normalizer.normalize(board)))
+            self.assert_same_boards(bit_board.copy(), board)
+
+
+class BoardNormalizerTest(unittest.TestCase):
+    # (width, height, placements)
+    SIZES = [(3, 2, 4), (2, 3, 4), (4, 3, 3), (3, 3, 4), (4, 1, 4)]
+
+    def test_rectangles_have_four_symmetries(self):
+        for width, height in [(3, 2), (2, 3), (4, 3), (5, 1)]:
+            normalizer = BoardNormalizer.of(width, height)
+            assert_that(normalizer.names, contains('no_transform', 'vertical_mirror', 'horizontal_mirror', 'rotate_180'))
+
+    def test_squares_have_eight_symmetries(self):
+        for size in [1, 2, 3, 6]:
+            assert_that(len(BoardNormalizer.of(size, size).names), is_(8))
+
+    def assert_ids_match_brute_force(self, width, height, limit, board_class, exact):
+        classes = {}
+        for board in reachable_boards(width, height, limit, board_class):
+            candidate = OthelloCandidate(limit, board, exact=exact)
+            classes.setdefault(brute_force_canonical(rows_of(board)), set()).add(candidate._normalized_id)
+
+        for ids in classes.values():
+            assert_that(len(ids), is_(1))
+        ids = set(i for ids in classes.values() for i in ids)
+        assert_that(len(ids), is_(len(classes)))
+
+    def test_exact_ids_match_brute_force(self):
+        for width, height, limit in BoardNormalizerTest.SIZES:
+            self.assert_ids_match_brute_force(width, height, limit, Board, exact=True)
+
+    def test_hashed_ids_match_brute_force(self):
+        for width, height, limit in BoardNormalizerTest.SIZES:
+            self.assert_ids_match_brute_force(width, height, limit, Board, exact=False)
+            self.assert_ids_match_brute_force(width, height, limit, BitBoard, exact=False)
+
+    def test_processed_states_match_brute_force(self):
+        for width, height in [(4, 3), (3, 4), (3, 3)]:
+            limit = 3
+            search = Search(prune=False)
+            start = OthelloCandidate(limit, Board(width=width, height=height))
+            search.add_candiates(start.next_states())
+            search.search_single()
+
+            classes = set(brute_force_canonical(rows_of(b)) for b in reachable_boards(width, height, limit))
+            assert_that(len(search._processed), is_(len(classes)))
+
+    def test_children_of_symmetric_boards_cover_every_move(self):
+        for width, height, limit in [(3, 3, 3), (4, 2, 3), (4, 4, 2)]:
+            boards = [Board(width=width, height=height)] + reachable_boards(width, height, limit)
+            for board in boards:
+                candidate = OthelloCandidate(limit + 1, board)
+                every_move = set()
+                for r in range(height):
+                    for c in range(width):
+                        if board.get(r, c) != Board.EMPTY: continue
+                        for color in [Board.WHITE, Board.BLACK]:
+                            child = board.copy()
+                            child.place(r, c, color)
+                            every_move.add(OthelloCandidate(limit + 1, child)._normalized_id)
+                children = [child._normalized_id for child in candidate.next_states()]
+                assert_that(set(children), is_(every_move))
+
+        start = OthelloCandidate(1, Board(width=4, height=4))
+        assert_that(len(list(start.next_states())), is_(6))
+
+
+class TruncatedCheck(CollisionCheck):
+    '''
+    A CollisionCheck over hashes cut to 4 bits, so that most positions collide.
+    '''
+    def checked(self, hashed_id, exact_id):
+        return CollisionCheck.checked(self, hashed_id & 0xF, exact_id)
+
+
+class SpillingFlavor(ComparableCandidatesFlavor):
+    '''
+    Keeps few candidates in memory, so that most are spilled and read back,
+    as pickles or as records of codec.
+    '''
+    def __init__(self, codec=None, prefetch=False):
+        self.codec = codec
+        self.prefetch = prefetch
+
+    def create_candidates_list(self):
+        return BigHeap(max_threshold=20, min_threshold=5, key=lambda c: c.priority(), codec=self.codec, prefetch=self.prefetch)
+
+
+class CollisionCheckTest(unittest.TestCase):
+    def test_colliding_positions_get_distinct_ids(self):
+        check = TruncatedCheck()
+        classes = {}
+        for board in reachable_boards(3, 3, 3):
+            candidate = OthelloCandidate(3, board, check=check)
+            classes.setdefault(board.normalizer.normalize(board), set()).add(candidate._normalized_id)
+        assert_that(check.collisions, greater_than(0))
+        for ids in classes.values():
+            assert_that(len(ids), is_(1))
+        assert_that(len(set(i for ids in classes.values() for i in ids)), is_(len(classes)))
+
+    def test_same_bests_as_exact_ids(self):
+        for width, height, limit in [(3, 3, 4), (4, 4, 4)]:
+            # unpruned, so that the processed count does not depend on the order of pops
+            exact = Search(prune=False)
+            exact.add_candiates(OthelloCandidate(limit, Board(width=width, height=height), exact=True).next_states())
+            exact.search_single()
+
+            # spilled both as pickles and as records, which the prefetching thread checks
+            for packed in [False, True]:
+                check = TruncatedCheck()
+                start = OthelloCandidate(limit, Board(width=width, height=height), check=check)
+                codec = CandidateCodec.of(start) if packed else None
+                checked = Search(flavor=SpillingFlavor(codec, prefetch=packed), prune=False)
+                checked.add_candiates(start.next_states())
+                checked.search_single()
+
+                assert_that(check.collisions, greater_than(0))
+                assert_that(len(checked._processed), is_(len(exact._processed)))
+                assert_that(set(b.board.normalizer.normalize(b.board) for b in checked.final_bests()),
+                            is_(set(b.board.normalizer.normalize(b.board) for b in exact.final_bests())))
+
+
+class UpperBoundTest(unittest.TestCase):
+    def test_no_descendant_beats_the_bound(self):
+        # values are memoized by position and placements left, so they are shared between the boards
+        exact = DynamicProgrammingSearch()
+        for board in reachable_boards(4, 3, 3):
+            candidate = OthelloCandidate(5, board)
+            best_score = exact.search(candidate)
+            if best_score is not None:
+                assert_that(candidate.upper_bound(), greater_than_or_equal_to(best_score))
+
+    def test_bound_prunes_most_states(self):
+        start = OthelloCandidate(5, Board(width=4, height=4))
+        full = Search(prune=False)
+        full.add_candiates(start.next_states())
+        full.search_single()
+        pruned = Search()
+        pruned.add_candiates(start.next_states())
+        pruned.search_single()
+
+        assert_that(pruned.best_score, is_(full.best_score))
+        assert_that(set(b.normalized_id() for b in pruned.final_bests()),
+                    is_(set(b.normalized_id() for b in full.final_bests())))
+        # 6642 of 22073 states; a bound from the board size alone kept about two thirds
+        assert_that(len(pruned._processed) * 3, less_than(len(full._processed)))
+
+
+class DynamicProgrammingSearchTest(unittest.TestCase):
+    def test_same_bests_as_search(self):
+        assert_same_bests_as_search(lambda start: DynamicProgrammingSearch())
+
+
+class LayeredSearchTest(unittest.TestCase):
+    def test_same_bests_as_search(self):
+        # small runs so that every layer is merged from several files
+        assert_same_bests_as_search(lambda start: LayeredSearch(run_size=7), cases=[(3, 3, 4), (4, 3, 4), (4, 4, 3)])
+
+
+class CandidateCodecTest(unittest.TestCase):
+    def candidates(self, board_class, exact):
+        return [OthelloCandidate(5, board, exact=exact) for board in reachable_boards(4, 3, 4, board_class)]
+
+    def assert_same_candidate(self, actual, expected):
+        assert_that(actual.board.__class__.__name__, is_(expected.board.__class__.__name__))
+        assert_that(actual.board.state(), is_(expected.board.state()))
+        assert_that(actual._normalized_id, is_(expected._normalized_id))
+        assert_that(actual.distance_sum(), is_(expected.distance_sum()))
+        assert_that(actual.is_final(), is_(expected.is_final()))
+
+    def test_decoded_candidates_equal_originals(self):
+        for board_class in [Board, BitBoard]:
+            for exact in [False, True]:
+                candidates = self.candidates(board_class, exact)
+                codec = CandidateCodec.of(candidates[0])
+                for c in candidates:
+                    data = codec.encode(c)
+                    assert_that(len(data), is_(codec.size))
+                    self.assert_same_candidate(codec.decode(data), c)
+
+    def test_spilled_candidates_come_back_in_order(self):
+        candidates = self.candidates(Board, False)
+        heap = BigHeap(max_threshold=20, min_threshold=5, key=lambda c: c.priority(), codec=CandidateCodec.of(candidates[0]))
+        heap.extend(candidates)
+        assert_that(len(heap._storage._fragments), greater_than(0))
+
+        popped = [heap.pop() for _ in candidates]
+        assert_that([c.priority() for c in popped], is_(sorted([c.priority() for c in candidates], reverse=True)))
+        assert_that(sorted(c._normalized_id for c in popped), is_(sorted(c._normalized_id for c in candidates)))
+
+    def test_messages_carry_the_codec(self):
+        candidates = self.candidates(BitBoard, True)[:10]
+        codec = CandidateCodec.of(candidates[0])
+        decoded, message_codec = search_server.decode_message(search_server.encode(candidates, codec))
+        assert_that(message_codec.size, is_(codec.size))
+        for actual, expected in zip(decoded, candidates):
+            self.assert_same_candidate(actual, expected)
+        assert_that(search_server.decode_message(search_server.encode([], codec))[0], is_([]))
+
+
+if __name__=='__main__':
+    unittest.main()
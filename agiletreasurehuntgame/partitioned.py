@@ -0,0 +1,229 @@
+# coding: utf-8
+
+import multiprocessing
+import Queue
+
+from ringbuffer import CandidateRing
+from search import Search
+
+MASK = (1 << 64) - 1
+
+def owner_of(normalized_id, partitions):
+    '''
+    The partition owning a normalized id.  Ids are mixed first, as exact
+    ids differ in few bits.
+
+    >>> [owner_of(i, 4) for i in range(8)]
+    [0, 1, 2, 0, 1, 3, 0, 2]
+    '''
+    return int((((hash(normalized_id) * 0x9E3779B97F4A7C15) & MASK) >> 32) % partitions)
+
+
+class Quiescence(object):
+    '''
+    Tells the workers when none of them has anything left to do.  This is
+    not a distributed termination detection algorithm: every worker updates
+    the same sent, received and idle counters in shared memory under one
+    lock, and done is set once all workers are idle with everything sent
+    received.  Batches, or the candidates in them, are what is counted.  A
+    worker counts itself idle once its candidates run out, and received
+    work makes its worker busy again in the same critical section, so the
+    counters never show all idle with work in flight.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = multiprocessing.Lock()
+        self._sent = multiprocessing.Value('l', 0, lock=False)
+        self._received = multiprocessing.Value('l', 0, lock=False)
+        self._idle = multiprocessing.Value('l', 0, lock=False)
+        self.done = multiprocessing.Event()
+
+    def sent(self, count=1):
+        with self._lock:
+            self._sent.value += count
+
+    def received(self, was_idle, count=1):
+        with self._lock:
+            self._received.value += count
+            if was_idle: self._idle.value -= 1
+
+    def idle(self):
+        with self._lock:
+            self._idle.value += 1
+            if self._idle.value == self.workers and self._sent.value == self._received.value:
+                self.done.set()
+
+
+class PartitionWorker(Search):
+    '''
+    A Search which owns the candidates whose normalized ids fall in its
+    partition.  Children owned by other workers are sent to them in
+    batches; only the owner checks and records whether a state is
+    processed, so no processed table is shared.
+
+    Inboxes are multiprocessing.Queues, or CandidateRings which may take
+    only part of a batch; the rest stays in the outbox for a later send.
+    '''
+    def __init__(self, index, inboxes, quiescence, shared_best, batch_size):
+        Search.__init__(self)
+        self.index = index
+        self.inboxes = inboxes
+        self.quiescence = quiescence
+        self.shared_best = shared_best
+        self.batch_size = batch_size
+        self.outboxes = [[] for _ in inboxes]
+        self.expanded = 0
+
+    def owner(self, normalized_id):
+        return owner_of(normalized_id, len(self.inboxes))
+
+    def is_processed_id(self, normalized_id, score):
+        if self.owner(normalized_id) != self.index: return False
+        return Search.is_processed_id(self, normalized_id, score)
+
+    def add_candiates(self, candidates):
+        own = []
+        for c in candidates:
+            owner = self.owner(c._normalized_id)
+            if owner == self.index or c.is_final():
+                own.append(c)
+                continue
+            self.outboxes[owner].append(c)
+            if len(self.outboxes[owner]) >= self.batch_size:
+                self.send(owner)
+        Search.add_candiates(self, own)
+
+    def send(self, owner):
+        batch = self.outboxes[owner]
+        taken = self.inboxes[owner].put(batch)
+        if taken is None: taken = len(batch)    # a Queue takes it all
+        # counted by candidates; the sender stays busy until this is done
+        self.quiescence.sent(taken)
+        self.outboxes[owner] = batch[taken:]
+
+    def flush(self):
+        for owner, outbox in enumerate(self.outboxes):
+            if outbox: self.send(owner)
+
+    def add_processed(self, candidate):
+        Search.add_processed(self, candidate)
+        if self.best_score > self.shared_best.value:
+            with self.shared_best.get_lock():
+                if self.best_score > self.shared_best.value:
+                    self.shared_best.value = self.best_score
+
+    def receive(self, block, was_idle=False):
+        try:
+            batch = self.inboxes[self.index].get(block, 0.05)
+        except Queue.Empty:
+            return False
+        self.quiescence.received(was_idle, len(batch))
+        self.best_score = max(self.best_score, self.shared_best.value)
+        Search.add_candiates(self, batch)
+        return True
+
+    def run(self):
+        self.start_dumper()
+        while True:
+            while self.receive(block=False): pass
+            candidate = self.pop_candidate()
+            if candidate:
+                self.process_candidate(candidate)
+                self.expanded += 1
+                continue
+            self.flush()
+            if self.receive(block=False): continue
+            # an inbox was full; its owner drains it meanwhile
+            if any(self.outboxes): continue
+            self.quiescence.idle()
+            while not self.receive(block=True, was_idle=True):
+                if self.quiescence.done.is_set():
+                    return
+
+    def pop_candidate(self):
+        while len(self.candidates_list):
+            candidate = self.candidates_list.pop()
+            if not self.is_processed(candidate) and not self.is_pruned(candidate): return candidate
+        return None
+
+
+def run_worker(index, inboxes, quiescence, shared_best, batch_size, start_batch, results):
+    worker = PartitionWorker(index, inboxes, quiescence, shared_best, batch_size)
+    try:
+        Search.add_candiates(worker, start_batch)
+        worker.run()
+    except:
+        # the others would wait for this worker forever
+        quiescence.done.set()
+        raise
+    finally:
+        bests = [b for b in worker.bests if b.score() >= worker.best_score]
+        results.put((index, bests, len(worker._processed), worker.expanded))
+
+
+class PartitionedSearch(object):
+    '''
+    Searches with one process per partition of normalized ids.  Each
+    worker keeps its own frontier and processed table, and children are
+    routed in batches to the worker owning them.  With a codec, batches
+    go through CandidateRings of ring_capacity records in shared memory
+    instead of Queues.
+
+    >>> from othello import OthelloCandidate, Board
+    >>> search = PartitionedSearch(workers=2, batch_size=4)
+    >>> search.search(OthelloCandidate(3, Board(width=3, height=3)))
+    1
+    >>> for b in search.final_bests():
+    ...    print b.board.dump()
+    ('...',
+     'BBB',
+     '...')
+    ('B..',
+     '.B.',
+     '..B')
+    ('B..',
+     'B..',
+     'B..')
+    '''
+    def __init__(self, workers=2, batch_size=64, codec=None, ring_capacity=1 << 16):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.codec = codec
+        self.ring_capacity = ring_capacity
+        self.bests = []
+        self.best_score = None
+        self.worker_stats = []
+
+    def search(self, start):
+        if self.codec:
+            inboxes = [CandidateRing(self.codec, self.ring_capacity) for _ in range(self.workers)]
+        else:
+            inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+        quiescence = Quiescence(self.workers)
+        shared_best = multiprocessing.Value('l', 0)
+        results = multiprocessing.Queue()
+
+        # every worker starts with the children it owns, which need not fit its inbox
+        batches = [[] for _ in range(self.workers)]
+        for c in start.next_states():
+            batches[owner_of(c._normalized_id, self.workers)].append(c)
+
+        processes = [multiprocessing.Process(target=run_worker, args=(i, inboxes, quiescence, shared_best, self.batch_size, batches[i], results))
+                     for i in range(self.workers)]
+        [p.start() for p in processes]
+        # results are taken before join, as a process does not end until its queue is flushed
+        collected = sorted(results.get() for _ in processes)
+        [p.join() for p in processes]
+
+        self.worker_stats = [(processed, expanded) for _, _, processed, expanded in collected]
+        bests = [b for _, worker_bests, _, _ in collected for b in worker_bests]
+        if bests:
+            self.best_score = max(b.score() for b in bests)
+        unique = {}
+        for b in bests:
+            if b.score() == self.best_score: unique[b._normalized_id] = b
+        self.bests = unique.values()
+        return self.best_score
+
+    def final_bests(self):
+        return sorted(self.bests, key=lambda c: c.dump())
@@ -0,0 +1,26 @@
+# coding: utf-8
+
+import unittest
+
+from othello import CandidateCodec
+from othello_test import assert_same_bests_as_search
+from partitioned import PartitionedSearch
+
+
+class PartitionedSearchTest(unittest.TestCase):
+    def test_same_bests_as_search(self):
+        assert_same_bests_as_search(lambda start: PartitionedSearch(workers=3, batch_size=8))
+
+    def test_same_bests_through_rings(self):
+        # rings smaller than a batch, so that sends are often partial
+        assert_same_bests_as_search(lambda start: PartitionedSearch(workers=3, batch_size=16, codec=CandidateCodec.of(start), ring_capacity=8),
+                                    cases=[(4, 4, 4)])
+
+    def test_start_children_beyond_ring_capacity(self):
+        # 6 start children for one worker, whose ring holds 2
+        assert_same_bests_as_search(lambda start: PartitionedSearch(workers=1, codec=CandidateCodec.of(start), ring_capacity=2),
+                                    cases=[(4, 4, 3)])
+
+
+if __name__=='__main__':
+    unittest.main()
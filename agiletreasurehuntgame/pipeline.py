@@ -0,0 +1,116 @@
+# coding: utf-8
+
+import multiprocessing
+
+from search import Search
+
+_codec = None
+
+def init_worker(codec):
+    global _codec
+    _codec = codec
+
+def expand(task):
+    '''
+    Expands the parents packed in data, in a pool worker.  Returns the
+    normalized ids and scores of their children, and the children packed
+    the same way, so that the master decodes only those it keeps.  A child
+    reached from several parents of the chunk is returned once, with its
+    highest score; children whose upper_bound() is below best_score are
+    dropped, as Search.is_pruned() would.
+    '''
+    data, best_score = task
+    codec = _codec
+    children = {}
+    for offset in xrange(0, len(data), codec.size):
+        for child in codec.decode(data, offset).next_states():
+            bound = child.upper_bound()
+            if best_score is not None and bound is not None and bound < best_score: continue
+            known = children.get(child._normalized_id)
+            if known is None or child.score() > known[0]:
+                children[child._normalized_id] = (child.score(), child)
+    ids = children.keys()
+    scores = [children[i][0] for i in ids]
+    return ids, scores, ''.join(codec.encode(children[i][1]) for i in ids)
+
+
+class PipelineSearch(Search):
+    '''
+    A Search which pops up to batch_size candidates at a time, best first,
+    and has a multiprocessing.Pool expand them in chunks of chunk_size.
+    Parents and children travel as codec records.  The ordering, dedup
+    and pruning stay here: the batch is marked processed before its
+    children come back, which are then filtered and added as by
+    process_candidate().
+
+    >>> from othello import OthelloCandidate, Board, CandidateCodec
+    >>> start = OthelloCandidate(3, Board(width=3, height=3))
+    >>> search = PipelineSearch(CandidateCodec.of(start), processes=2, batch_size=8, chunk_size=2)
+    >>> search.search(start)
+    1
+    >>> for b in search.final_bests():
+    ...    print b.board.dump()
+    ('...',
+     'BBB',
+     '...')
+    ('B..',
+     '.B.',
+     '..B')
+    ('B..',
+     'B..',
+     'B..')
+    '''
+    def __init__(self, codec, processes=None, batch_size=512, chunk_size=32, dump=False, flavor=None):
+        Search.__init__(self, dump=dump, flavor=flavor)
+        self.codec = codec
+        self.processes = processes
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.batches = 0
+
+    def search(self, start):
+        self.add_candiates(start.next_states())
+        self.search_pipeline()
+        return self.best_score
+
+    def pop_batch(self):
+        batch = {}
+        while len(batch) < self.batch_size and len(self.candidates_list):
+            candidate = self.candidates_list.pop()
+            if self.is_processed(candidate) or self.is_pruned(candidate): continue
+            known = batch.get(candidate._normalized_id)
+            if known is None or candidate.score() > known.score():
+                batch[candidate._normalized_id] = candidate
+        return batch.values()
+
+    def search_pipeline(self):
+        pool = multiprocessing.Pool(self.processes, initializer=init_worker, initargs=(self.codec,))
+        try:
+            self.start_dumper()
+            while True:
+                batch = self.pop_batch()
+                if not batch: break
+                self.batches += 1
+                for candidate in batch:
+                    self.dumper.cycle(candidate)
+                    self.add_processed(candidate)
+                encode = self.codec.encode
+                chunks = [''.join(encode(c) for c in batch[i:i + self.chunk_size])
+                          for i in range(0, len(batch), self.chunk_size)]
+                # as in is_pruned(), no bound can prune before a positive best_score
+                best_score = self.best_score if self.prune and self.best_score > 0 else None
+                for ids, scores, data in pool.imap_unordered(expand, [(c, best_score) for c in chunks]):
+                    self.add_children(ids, scores, data)
+            self.dumper.final_best(self.bests)
+            return self.bests
+        finally:
+            pool.close()
+            pool.join()
+
+    def add_children(self, ids, scores, data):
+        codec = self.codec
+        children = []
+        for i, (normalized_id, score) in enumerate(zip(ids, scores)):
+            if self.is_processed_id(normalized_id, score): continue
+            children.append(codec.decode(data, i * codec.size))
+        self.add_candiates(children)
@@ -0,0 +1,20 @@
+# coding: utf-8
+
+import unittest
+
+from othello import BitBoard, CandidateCodec
+from othello_test import assert_same_bests_as_search
+from pipeline import PipelineSearch
+
+
+class PipelineSearchTest(unittest.TestCase):
+    def test_same_bests_as_search(self):
+        assert_same_bests_as_search(lambda start: PipelineSearch(CandidateCodec.of(start), processes=2, batch_size=32, chunk_size=4))
+
+    def test_same_bests_with_bitboards(self):
+        assert_same_bests_as_search(lambda start: PipelineSearch(CandidateCodec.of(start), processes=2, batch_size=32, chunk_size=4),
+                                    cases=[(4, 3, 4)], board_class=BitBoard)
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,486 @@
+# coding: utf-8
+
+from array import array
+from bisect import bisect_right
+from itertools import izip
+import heapq
+import mmap
+import multiprocessing
+import struct
+import tempfile
+import time
+
+class ProcessedTable(object):
+    '''
+    Maps normalized ids (non-negative ints) to scores like a dict, with
+    open addressing over two typed arrays: 8 bytes per key and 2 bytes per
+    score, at most half full.  Keys or scores which do not fit the arrays
+    go to a plain dict.
+
+    >>> processed = ProcessedTable(capacity=4)
+    >>> processed[12345] = 3
+    >>> processed[7] = 1
+    >>> 12345 in processed, 8 in processed
+    (True, False)
+    >>> processed[12345], processed.get(8), processed.get(8, -1)
+    (3, None, -1)
+    >>> processed[12345] = 5
+    >>> for i in range(100): processed[i * 1000003] = i % 7
+    >>> len(processed), processed[12345], processed[99 * 1000003]
+    (102, 5, 1)
+    >>> processed.capacity
+    256
+    >>> processed[2 ** 80] = 1
+    >>> processed[2 ** 80], len(processed)
+    (1, 103)
+    >>> processed[8]
+    Traceback (most recent call last):
+        ...
+    KeyError: 8
+    '''
+    EMPTY = -1
+    KEY_LIMIT = 2 ** (array('l').itemsize * 8 - 1)
+    SCORE_LIMIT = 2 ** (array('h').itemsize * 8 - 1)
+
+    def __init__(self, capacity=1024, max_load=0.5):
+        capacity = max(capacity, 2)
+        self.capacity = 1 << (capacity - 1).bit_length()
+        self._shift = 64 - (self.capacity - 1).bit_length()
+        self.max_load = max_load
+        self._keys = array('l', [ProcessedTable.EMPTY]) * self.capacity
+        self._scores = array('h', [0]) * self.capacity
+        self._count = 0
+        self._overflow = {}
+
+    @staticmethod
+    def fits(key, score=0):
+        return (0 <= key < ProcessedTable.KEY_LIMIT and
+                -ProcessedTable.SCORE_LIMIT <= score < ProcessedTable.SCORE_LIMIT)
+
+    def slot(self, key):
+        '''
+        The slot holding key, or the empty slot where it belongs.
+        '''
+        keys = self._keys
+        mask = self.capacity - 1
+        # fibonacci hashing; exact ids differ in few bits, which are spread
+        # over the top bits of the 64 bit product
+        i = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+        while True:
+            k = keys[i]
+            if k == key or k == ProcessedTable.EMPTY: return i
+            i = (i + 1) & mask
+
+    def get(self, key, default=None):
+        if not 0 <= key < ProcessedTable.KEY_LIMIT:
+            return self._overflow.get(key, default)
+        i = self.slot(key)
+        if self._keys[i] == ProcessedTable.EMPTY:
+            return self._overflow.get(key, default)
+        return self._scores[i]
+
+    def __getitem__(self, key):
+        score = self.get(key)
+        if score is None: raise KeyError(key)
+        return score
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, score):
+        if not ProcessedTable.fits(key, score):
+            if key in self: self.remove(key)
+            self._overflow[key] = score
+            return
+        i = self.slot(key)
+        if self._keys[i] == ProcessedTable.EMPTY:
+            if key in self._overflow:
+                del self._overflow[key]
+            self._keys[i] = key
+            self._count += 1
+            self._scores[i] = score
+            if self._count > self.capacity * self.max_load:
+                self.grow()
+        else:
+            self._scores[i] = score
+
+    def remove(self, key):
+        '''
+        Only used to move a key whose new score does not fit to the overflow
+        dict; entries after the removed one are put back to keep probing
+        sequences unbroken.
+        '''
+        if key in self._overflow:
+            del self._overflow[key]
+            return
+        i = self.slot(key)
+        self._keys[i] = ProcessedTable.EMPTY
+        self._count -= 1
+        mask = self.capacity - 1
+        i = (i + 1) & mask
+        while self._keys[i] != ProcessedTable.EMPTY:
+            key, score = self._keys[i], self._scores[i]
+            self._keys[i] = ProcessedTable.EMPTY
+            j = self.slot(key)
+            self._keys[j] = key
+            self._scores[j] = score
+            i = (i + 1) & mask
+
+    def grow(self):
+        keys, scores = self._keys, self._scores
+        self.capacity *= 2
+        self._shift -= 1
+        self._keys = array('l', [ProcessedTable.EMPTY]) * self.capacity
+        self._scores = array('h', [0]) * self.capacity
+        for key, score in izip(keys, scores):
+            if key == ProcessedTable.EMPTY: continue
+            i = self.slot(key)
+            self._keys[i] = key
+            self._scores[i] = score
+
+    def __len__(self):
+        return self._count + len(self._overflow)
+
+    def __iter__(self):
+        for key in self._keys:
+            if key != ProcessedTable.EMPTY: yield key
+        for key in self._overflow:
+            yield key
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def nbytes(self):
+        '''
+        Bytes taken by the arrays, without the overflow dict.
+        '''
+        return self._keys.itemsize * len(self._keys) + self._scores.itemsize * len(self._scores)
+
+
+class Segment(object):
+    '''
+    Sorted keys and their scores in a memory-mapped temporary file: every
+    key as array('l') followed by every score as array('h').  Every
+    BLOCK-th key is kept on memory, so a lookup bisects those and then
+    the keys of one block, read in place from the map.
+
+    >>> segment = Segment(array('l', range(0, 3000, 3)), array('h', [1] * 1000))
+    >>> segment.get(2997), segment.get(2998), segment.get(-1), segment.get(3000)
+    (1, None, None, None)
+    >>> len(segment), list(segment.iteritems())[-2:]
+    (1000, [(2994, 1), (2997, 1)])
+    '''
+    BLOCK = 256
+
+    def __init__(self, keys, scores):
+        self._file = tempfile.TemporaryFile()
+        self._file.write(keys.tostring())
+        self._file.write(scores.tostring())
+        self._file.flush()
+        self._count = len(keys)
+        self._key_size = keys.itemsize
+        self._score_size = scores.itemsize
+        self._scores_offset = len(keys) * keys.itemsize
+        self._fence = keys[::Segment.BLOCK]
+        self._key = struct.Struct(keys.typecode)
+        self._score = struct.Struct(scores.typecode)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._count else None
+
+    def keys_between(self, start, end):
+        keys = array('l')
+        keys.fromstring(self._map[start * self._key_size:end * self._key_size])
+        return keys
+
+    def scores_between(self, start, end):
+        scores = array('h')
+        scores.fromstring(self._map[self._scores_offset + start * self._score_size:self._scores_offset + end * self._score_size])
+        return scores
+
+    def get(self, key, default=None):
+        b = bisect_right(self._fence, key) - 1
+        if b < 0: return default
+        # bisect_left over the block without copying it
+        unpack, m, size = self._key.unpack_from, self._map, self._key_size
+        lo = b * Segment.BLOCK
+        end = hi = min(lo + Segment.BLOCK, self._count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpack(m, mid * size)[0] < key: lo = mid + 1
+            else: hi = mid
+        if lo == end or unpack(m, lo * size)[0] != key: return default
+        return self._score.unpack_from(m, self._scores_offset + lo * self._score_size)[0]
+
+    def iteritems(self, chunk=65536):
+        for start in xrange(0, self._count, chunk):
+            end = min(start + chunk, self._count)
+            for item in izip(self.keys_between(start, end), self.scores_between(start, end)):
+                yield item
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._map: self._map.close()
+        self._file.close()
+
+
+class SpillingProcessedTable(object):
+    '''
+    A processed table which grows beyond memory.  New entries go to a hot
+    ProcessedTable; when it holds hot_limit entries they are written to a
+    sorted Segment on disk.  Lookups try the hot table and then segments,
+    newest first.  Segments are merged in tiers, newer scores winning: the
+    newest two are merged while the older one is less than ratio times the
+    size of the newer, so segment sizes grow geometrically, there are
+    O(log(n / hot_limit)) of them, and every entry is rewritten O(log)
+    times.  Ids too large for a segment stay on memory.
+
+    >>> processed = SpillingProcessedTable(hot_limit=4)
+    >>> for i in range(10): processed[i * 7] = i
+    >>> processed[7] = 20
+    >>> len(processed), [len(s) for s in processed._segments], processed[7], processed[63], processed.get(64)
+    (10, [8], 20, 9, None)
+    >>> for i in range(10): processed[i * 7 + 1] = i
+    >>> len(processed), [len(s) for s in processed._segments], processed[0], processed[7], processed[64]
+    (20, [15, 4], 0, 20, 9)
+    >>> processed[2 ** 70] = 3
+    >>> for i in range(10): processed[i * 7 + 2] = i
+    >>> len(processed), processed[2 ** 70]
+    (31, 3)
+    '''
+    def __init__(self, hot_limit=1 << 20, ratio=2):
+        self.hot_limit = hot_limit
+        self.ratio = ratio
+        self._hot = ProcessedTable()
+        self._segments = []     # oldest, and largest, first
+        self._count = 0
+        # Search sets an id right after missing it, so the miss is remembered
+        self._last_miss = None
+
+    def get_cold(self, key, default=None):
+        for segment in reversed(self._segments):
+            score = segment.get(key)
+            if score is not None: return score
+        return default
+
+    def get(self, key, default=None):
+        score = self._hot.get(key)
+        if score is not None: return score
+        if not 0 <= key < ProcessedTable.KEY_LIMIT: return default
+        score = self.get_cold(key)
+        if score is None:
+            self._last_miss = key
+            return default
+        return score
+
+    def __getitem__(self, key):
+        score = self.get(key)
+        if score is None: raise KeyError(key)
+        return score
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, score):
+        if key not in self._hot and (key == self._last_miss or self.get_cold(key) is None):
+            self._count += 1
+        self._hot[key] = score
+        if len(self._hot) - len(self._hot._overflow) >= self.hot_limit:
+            self.spill()
+
+    def spill(self):
+        hot = self._hot
+        keys = array('l', sorted(key for key in hot._keys if key != ProcessedTable.EMPTY))
+        scores = array('h', (hot[key] for key in keys))
+        self._segments.append(Segment(keys, scores))
+        self._hot = ProcessedTable()
+        self._hot._overflow = hot._overflow
+        self._last_miss = None
+        segments = self._segments
+        while len(segments) > 1 and len(segments[-2]) < self.ratio * len(segments[-1]):
+            segments[-2:] = [self.merge(segments[-2:])]
+
+    @staticmethod
+    def merge(segments):
+        '''
+        Merges segments, oldest first, into one; for keys in several
+        segments the score of the newest is kept.
+        '''
+        def stream(age, segment):
+            # (key, -age, score) puts the newest first among equal keys
+            for key, score in segment.iteritems():
+                yield key, -age, score
+        streams = [stream(age, segment) for age, segment in enumerate(segments)]
+        keys, scores = array('l'), array('h')
+        last = None
+        for key, _, score in heapq.merge(*streams):
+            if key == last: continue
+            last = key
+            keys.append(key)
+            scores.append(score)
+        for segment in segments: segment.close()
+        return Segment(keys, scores)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        for segment in self._segments: segment.close()
+        self._segments = []
+
+
+class SharedProcessedTable(object):
+    '''
+    A processed table in shared memory, for processes forked after it is
+    made.  Keys and scores are multiprocessing.RawArrays used for open
+    addressing with a fixed capacity; ids which do not fit, or arrive when
+    the table is max_load full, go to overflow (such as a Manager dict).
+    Each id is kept in one place: the table, or overflow.  Scores must fit
+    a slot, whichever place their id is kept in.
+
+    Lookups take no lock, and go to overflow on a miss only once something
+    which could be in the table has gone there.  Writers of an id hold the
+    lock of its stripe of key_locks, so a score only ever rises and an id
+    is not added twice.  A writer claims an empty slot under the lock of
+    the slot's stripe of slot_locks, writing the score before the key, so
+    a reader which finds the key also finds its score.  A stored key is
+    id + 1, as the arrays start zeroed.
+
+    >>> processed = SharedProcessedTable(capacity=16, overflow={})
+    >>> for i in range(10): processed[i * 3] = i
+    >>> processed[3] = 7
+    >>> processed[6] = 0
+    >>> len(processed), processed[3], processed[6], processed.get(4), 27 in processed
+    (10, 7, 2, None, True)
+    >>> processed[2 ** 70] = 1
+    >>> len(processed), processed[2 ** 70], processed.overflow
+    (11, 1, {1180591620717411303424L: 1})
+    >>> processed[4] = 40000
+    Traceback (most recent call last):
+        ...
+    ValueError: score 40000 does not fit a slot
+    '''
+    EMPTY = 0
+
+    def __init__(self, capacity=1 << 22, overflow=None, stripes=64, max_load=0.7):
+        self.capacity = 1 << (max(capacity, 2) - 1).bit_length()
+        self._shift = 64 - (self.capacity - 1).bit_length()
+        self.limit = int(self.capacity * max_load)
+        self._keys = multiprocessing.RawArray('l', self.capacity)
+        self._scores = multiprocessing.RawArray('h', self.capacity)
+        # a writer may take a slot lock while holding a key lock, never the other way
+        self._key_locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self._slot_locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self._count = multiprocessing.Value('l', 0)
+        # ids which fit a slot but went to overflow
+        self._spilled = multiprocessing.Value('l', 0)
+        self.overflow = overflow if overflow is not None else {}
+
+    def home(self, key):
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+
+    def slot(self, key):
+        '''
+        The slot holding key, or the first empty slot of its probe sequence.
+        '''
+        stored = key + 1
+        keys = self._keys
+        mask = self.capacity - 1
+        i = self.home(key)
+        while True:
+            k = keys[i]
+            if k == stored or k == SharedProcessedTable.EMPTY: return i
+            i = (i + 1) & mask
+
+    def get(self, key, default=None):
+        if not ProcessedTable.fits(key + 1):
+            return self.overflow.get(key, default)
+        i = self.slot(key)
+        if self._keys[i] == SharedProcessedTable.EMPTY:
+            if self._spilled.value:
+                return self.overflow.get(key, default)
+            return default
+        return self._scores[i]
+
+    def __getitem__(self, key):
+        score = self.get(key)
+        if score is None: raise KeyError(key)
+        return score
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def raise_overflow(self, key, score):
+        known = self.overflow.get(key)
+        if known is None or score > known:
+            self.overflow[key] = score
+        return known is None
+
+    def __setitem__(self, key, score):
+        '''
+        Keeps the highest score set for key, as Search only raises them.
+        '''
+        if not ProcessedTable.fits(0, score):
+            raise ValueError('score %d does not fit a slot'%(score))
+        if not ProcessedTable.fits(key + 1):
+            with self._key_locks[hash(key) % len(self._key_locks)]:
+                self.raise_overflow(key, score)
+            return
+        stored = key + 1
+        with self._key_locks[self.home(key) % len(self._key_locks)]:
+            while True:
+                i = self.slot(key)
+                if self._keys[i] == stored:
+                    if score > self._scores[i]: self._scores[i] = score
+                    return
+                if self._spilled.value and self.overflow.get(key) is not None:
+                    self.raise_overflow(key, score)
+                    return
+                if self._count.value >= self.limit:
+                    with self._spilled.get_lock():
+                        self._spilled.value += 1
+                    self.raise_overflow(key, score)
+                    return
+                with self._slot_locks[i % len(self._slot_locks)]:
+                    if self._keys[i] != SharedProcessedTable.EMPTY:
+                        continue    # taken by another id meanwhile; probe again
+                    self._scores[i] = score
+                    self._keys[i] = stored
+                with self._count.get_lock():
+                    self._count.value += 1
+                return
+
+    def __len__(self):
+        return self._count.value + len(self.overflow)
+
+
+def benchmark(operations=200000, processes=2):
+    '''
+    Prints the time taken by processes forked workers doing get() and then
+    setting new ids, as Search does, on each kind of processed table.
+    '''
+    import random
+
+    def work(table, seed):
+        r = random.Random(seed)
+        for _ in xrange(operations // processes):
+            key = r.getrandbits(40)
+            if table.get(key) is None: table[key] = 1
+
+    manager = multiprocessing.Manager()
+    tables = [
+        ('manager.dict', manager.dict()),
+        ('SharedProcessedTable', SharedProcessedTable(operations * 2, overflow=manager.dict())),
+    ]
+    for name, table in tables:
+        started = time.time()
+        workers = [multiprocessing.Process(target=work, args=(table, seed)) for seed in range(processes)]
+        [w.start() for w in workers]
+        [w.join() for w in workers]
+        elapsed = time.time() - started
+        print '%-22s %d processes: %.2fs, %d ops/s, %d entries'%(name, processes, elapsed, operations / elapsed, len(table))
+
+
+if __name__=='__main__':
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
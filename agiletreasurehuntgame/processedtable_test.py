@@ -0,0 +1,137 @@
+# coding: utf-8
+
+import unittest
+from hamcrest import *
+import random
+import multiprocessing
+
+from processedtable import ProcessedTable, SpillingProcessedTable, SharedProcessedTable
+
+
+class ProcessedTableTest(unittest.TestCase):
+    def test_same_as_dict(self):
+        table = ProcessedTable(capacity=8)
+        expected = {}
+        keys = [random.getrandbits(63) for _ in range(2000)] + range(500) + [i << 40 for i in range(500)]
+        for _ in range(10000):
+            key = random.choice(keys)
+            score = random.randint(-5, 40)
+            table[key] = score
+            expected[key] = score
+
+        assert_that(len(table), is_(len(expected)))
+        assert_that(sorted(table.items()), is_(sorted(expected.items())))
+        for key in keys + [random.getrandbits(63) for _ in range(1000)]:
+            assert_that(key in table, is_(key in expected))
+            assert_that(table.get(key), is_(expected.get(key)))
+
+    def test_stays_half_full(self):
+        table = ProcessedTable()
+        for i in range(100000): table[i * 7919] = 1
+        assert_that(table.capacity, is_(262144))
+        assert_that(table.nbytes(), is_(262144 * 10))
+
+    def test_keys_and_scores_out_of_range(self):
+        table = ProcessedTable(capacity=4)
+        for i in range(20): table[i] = i
+        table[3] = 100000
+        table[2 ** 70] = 1
+        table[-1] = 2
+        assert_that(len(table), is_(22))
+        assert_that(sorted(table.items()), is_(sorted([(i, i) for i in range(20) if i != 3] + [(3, 100000), (2 ** 70, 1), (-1, 2)])))
+        table[3] = 4
+        assert_that(table[3], is_(4))
+        assert_that(len(table), is_(22))
+        for i in range(20):
+            assert_that(i in table, is_(True))
+
+
+class SpillingProcessedTableTest(unittest.TestCase):
+    def test_same_as_dict(self):
+        table = SpillingProcessedTable(hot_limit=300)
+        expected = {}
+        keys = [random.getrandbits(63) for _ in range(3000)] + [2 ** 64 + i for i in range(10)]
+        for _ in range(20000):
+            key = random.choice(keys)
+            score = random.randint(-5, 40)
+            # looked up first half of the time, as Search does
+            if random.random() < 0.5:
+                assert_that(table.get(key), is_(expected.get(key)))
+            table[key] = score
+            expected[key] = score
+            assert_that(len(table), is_(len(expected)))
+
+        assert_that(len(table._segments), is_(less_than_or_equal_to(4)))
+        for key in keys + [random.getrandbits(63) for _ in range(1000)]:
+            assert_that(table.get(key), is_(expected.get(key)))
+        table.close()
+
+    def test_segments_grow_in_tiers(self):
+        table = SpillingProcessedTable(hot_limit=100)
+        for key in random.sample(xrange(1 << 40), 25600):
+            table[key] = 1
+        sizes = [len(s) for s in table._segments]
+        # 256 spills leave one segment per set bit of 256
+        assert_that(sizes, is_([25600]))
+        table[1 << 41] = 1
+        assert_that(len(table), is_(25601))
+        table.close()
+
+
+def set_keys(table, keys):
+    for key in keys:
+        if table.get(key) is None: table[key] = key % 100
+
+def raise_scores(table, keys, seed):
+    for key in keys:
+        table[key] = random.Random(seed + key).randint(0, 1000)
+
+
+class SharedProcessedTableTest(unittest.TestCase):
+    def test_filled_by_processes(self):
+        table = SharedProcessedTable(capacity=1 << 13, overflow={}, stripes=4)
+        keys = [random.getrandbits(62) for _ in range(4000)]
+        # every key is set by two of the processes
+        processes = [multiprocessing.Process(target=set_keys, args=(table, keys[i * 1000:] + keys[:i * 1000][:1000]))
+                     for i in range(4)]
+        [p.start() for p in processes]
+        [p.join() for p in processes]
+
+        assert_that(len(table), is_(len(keys)))
+        for key in keys:
+            assert_that(table[key], is_(key % 100))
+        assert_that(table.get(keys[0] + 1), is_(None))
+
+    def test_overflow_when_full(self):
+        table = SharedProcessedTable(capacity=16, overflow={}, max_load=0.5)
+        for i in range(20): table[i] = i
+        assert_that(len(table), is_(20))
+        assert_that(len(table.overflow), is_(12))
+        assert_that([table[i] for i in range(20)], is_(range(20)))
+
+    def test_overflow_is_searched_once_the_table_is_full(self):
+        table = SharedProcessedTable(capacity=16, overflow={}, max_load=0.5)
+        for i in range(8): table[i] = 1
+        table[100] = 2
+        table[100] = 5
+        table[100] = 3
+        table[2 ** 70] = 4
+        assert_that((table.get(100), table.get(2 ** 70), table.get(101), len(table)), is_((5, 4, None, 10)))
+        assert_that(sorted(table.overflow), is_([100, 2 ** 70]))
+        self.assertRaises(ValueError, table.__setitem__, 200, 40000)
+
+    def test_scores_only_rise_with_concurrent_writers(self):
+        table = SharedProcessedTable(capacity=1 << 12, overflow={}, stripes=4)
+        keys = [random.getrandbits(62) for _ in range(500)]
+        processes = [multiprocessing.Process(target=raise_scores, args=(table, keys, seed)) for seed in range(4)]
+        [p.start() for p in processes]
+        [p.join() for p in processes]
+
+        expected = dict((key, max(random.Random(seed + key).randint(0, 1000) for seed in range(4))) for key in keys)
+        assert_that(len(table), is_(len(keys)))
+        for key in keys:
+            assert_that(table[key], is_(expected[key]))
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# coding: utf-8
+
+import mmap
+import multiprocessing
+import Queue
+
+class RingBuffer(object):
+    '''
+    A bounded FIFO of fixed-size records in an anonymous shared mmap, for
+    processes forked after it is made.  Records are pushed and popped as
+    strings of whole records, many at a time, under one lock; head and
+    tail count records ever popped and pushed.
+
+    >>> ring = RingBuffer(record_size=2, capacity=4)
+    >>> ring.push('aabbcc')
+    3
+    >>> ring.pop(2), len(ring)
+    ('aabb', 1)
+    >>> ring.push('ddeeffgg', block=False)
+    3
+    >>> ring.pop(), ring.pop(block=False)
+    ('ccddeeff', '')
+    '''
+    def __init__(self, record_size, capacity=4096):
+        self.record_size = record_size
+        self.capacity = capacity
+        self._map = mmap.mmap(-1, record_size * capacity)
+        self._positions = multiprocessing.RawArray('l', 2)
+        self._lock = multiprocessing.Lock()
+        self._not_empty = multiprocessing.Condition(self._lock)
+        self._not_full = multiprocessing.Condition(self._lock)
+
+    def __len__(self):
+        head, tail = self._positions
+        return tail - head
+
+    def free(self):
+        return self.capacity - len(self)
+
+    def push(self, data, block=True, timeout=None):
+        '''
+        Pushes the records in data, waiting for room unless block is false.
+        Returns the number of records pushed, which is less than given
+        only when the ring stays full.
+        '''
+        size = self.record_size
+        count = len(data) // size
+        pushed = 0
+        with self._lock:
+            while pushed < count:
+                head, tail = self._positions
+                room = self.capacity - (tail - head)
+                if not room:
+                    if not block: break
+                    self._not_full.wait(timeout)
+                    if timeout is not None and len(self) == self.capacity: break
+                    continue
+                n = min(room, count - pushed)
+                self._write(tail, data[pushed * size:(pushed + n) * size])
+                self._positions[1] = tail + n
+                pushed += n
+                self._not_empty.notify_all()
+        return pushed
+
+    def pop(self, count=None, block=True, timeout=None):
+        '''
+        Pops up to count records, all available when count is None, as one
+        string.  Waits for a record unless block is false; returns '' when
+        none comes.
+        '''
+        with self._lock:
+            while not len(self):
+                if not block: return ''
+                self._not_empty.wait(timeout)
+                if timeout is not None and not len(self): return ''
+            head, tail = self._positions
+            n = tail - head if count is None else min(count, tail - head)
+            data = self._read(head, n)
+            self._positions[0] = head + n
+            self._not_full.notify_all()
+        return data
+
+    def _write(self, position, data):
+        start = (position % self.capacity) * self.record_size
+        first = min(len(data), len(self._map) - start)
+        self._map[start:start + first] = data[:first]
+        self._map[0:len(data) - first] = data[first:]
+
+    def _read(self, position, count):
+        start = (position % self.capacity) * self.record_size
+        end = start + count * self.record_size
+        if end <= len(self._map):
+            return self._map[start:end]
+        return self._map[start:] + self._map[0:end - len(self._map)]
+
+
+class CandidateRing(object):
+    '''
+    Passes candidates between processes as codec records in a RingBuffer,
+    with the put and get of multiprocessing.Queue taking lists.  put()
+    never waits: it takes as many candidates as there is room for and
+    returns how many it took.
+
+    >>> from othello import OthelloCandidate, Board, CandidateCodec
+    >>> start = OthelloCandidate(3, Board(width=3, height=3))
+    >>> children = list(start.next_states())
+    >>> ring = CandidateRing(CandidateCodec.of(start), capacity=4)
+    >>> ring.put(children), len(children)
+    (4, 6)
+    >>> [c._normalized_id for c in ring.get()] == [c._normalized_id for c in children[:4]]
+    True
+    >>> ring.get(block=False)
+    Traceback (most recent call last):
+        ...
+    Empty
+    '''
+    def __init__(self, codec, capacity=1 << 16):
+        self.codec = codec
+        self.ring = RingBuffer(codec.size, capacity)
+
+    def put(self, candidates):
+        candidates = candidates[:self.ring.free()]
+        return self.ring.push(''.join(self.codec.encode(c) for c in candidates), block=False)
+
+    def get(self, block=True, timeout=None):
+        data = self.ring.pop(block=block, timeout=timeout)
+        if not data: raise Queue.Empty
+        size = self.codec.size
+        return [self.codec.decode(data, offset) for offset in xrange(0, len(data), size)]
@@ -0,0 +1,57 @@
+# coding: utf-8
+
+import unittest
+import multiprocessing
+from hamcrest import *
+
+from ringbuffer import RingBuffer
+
+
+def records(producer, count):
+    return ''.join('%02d%06d'%(producer, i) for i in range(count))
+
+def produce(ring, producer, count, batch):
+    data = records(producer, count)
+    for start in range(0, len(data), batch * ring.record_size):
+        ring.push(data[start:start + batch * ring.record_size])
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_records_come_back_in_order_across_the_end(self):
+        ring = RingBuffer(record_size=8, capacity=7)
+        data = records(0, 100)
+        popped = []
+        for start in range(0, len(data), 5 * 8):
+            assert_that(ring.push(data[start:start + 5 * 8]), is_(5))
+            popped.append(ring.pop(3))
+            popped.append(ring.pop())
+        assert_that(''.join(popped), is_(data))
+        assert_that(len(ring), is_(0))
+
+    def test_full_ring_takes_what_fits(self):
+        ring = RingBuffer(record_size=8, capacity=4)
+        assert_that(ring.push(records(0, 6), block=False), is_(4))
+        assert_that(ring.push(records(0, 1), timeout=0.01), is_(0))
+        assert_that(ring.pop(), is_(records(0, 4)))
+
+    def test_producers_in_other_processes(self):
+        ring = RingBuffer(record_size=8, capacity=64)
+        producers = [multiprocessing.Process(target=produce, args=(ring, p, 1000, 50)) for p in range(3)]
+        [p.start() for p in producers]
+        received = {}
+        total = 0
+        while total < 3000:
+            data = ring.pop(timeout=5)
+            assert_that(len(data), greater_than(0))
+            for i in range(0, len(data), 8):
+                received.setdefault(data[i:i + 2], []).append(data[i:i + 8])
+            total += len(data) // 8
+        [p.join() for p in producers]
+
+        # records of each producer keep their order
+        for p in range(3):
+            assert_that(''.join(received['%02d'%(p)]), is_(records(p, 1000)))
+
+
+if __name__=='__main__':
+    unittest.main()
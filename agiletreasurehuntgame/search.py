@@ -1,7 +1,14 @@
 # coding: utf-8
 
 import bigheap
+import bloomfilter
+import processedtable
 import datetime
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
 
 class StdoutDumper(object):
     INTERVAL = 1000
@@ -66,17 +73,17 @@ class Search(object):
     >>> bests = search.search_single()
     >>> for b in search.final_bests():
     ...    print b.board.dump(history=True)
+    ('...',
+     'BBB',
+     '...')(1, 0, 2)(1, 1, 1)(1, 2, 2)
     ('B..',
      '.B.',
-     '..B')(1, 1, 1)(2, 2, 2)(0, 0, 2)
-    ('.B.',
-     '.B.',
-     '.B.')(1, 1, 1)(2, 1, 2)(0, 1, 2)
-    ('...',
-     '...',
-     'BBB')(2, 1, 1)(2, 2, 2)(2, 0, 2)
+     '..B')(0, 0, 2)(1, 1, 1)(2, 2, 2)
+    ('B..',
+     'B..',
+     'B..')(0, 0, 2)(1, 0, 1)(2, 0, 2)
     '''
-    def __init__(self, dump=False, flavor=None):
+    def __init__(self, dump=False, flavor=None, prune=True):
         if not flavor:
             flavor = ComparableCandidatesFlavor
         self.candidates_list = flavor.create_candidates_list()
@@ -84,6 +91,7 @@ class Search(object):
         self._processed = flavor.create_processed()
         self.best_score = 0
         self.bests = flavor.create_bests()
+        self.prune = prune
 
     def start_dumper(self):
         if self.dump:
@@ -104,15 +112,19 @@ class Search(object):
     def process_candidate(self, candidate):
         self.dumper.cycle(candidate)
         if not candidate.is_final():
-            self.add_candiates(candidate.next_states())
+            self.add_candiates(candidate.next_states(self.is_processed_id))
         self.add_processed(candidate)
 
     def candidates(self):
         while True:
             if len(self.candidates_list) == 0: raise StopIteration
             # making it pop(0) slows down the operation dramatically
-            candidate = self.candidates_list.pop()
-            if not self.is_processed(candidate): yield candidate
+            try:
+                candidate = self.candidates_list.pop()
+            except IndexError:
+                # a queue shared with other processes ran out of work after len() was checked
+                raise StopIteration
+            if not self.is_processed(candidate) and not self.is_pruned(candidate): yield candidate
 
     def pop_candidate(self):
         while True:
@@ -120,36 +132,267 @@ class Search(object):
                 self.dumper.final_best(self.bests)
                 return None
             candidate = self.candidates_list.pop()
-            if not self.is_processed(candidate): return candidate
+            if not self.is_processed(candidate) and not self.is_pruned(candidate): return candidate
 
     def add_candiates(self, candidates):
+        batch = []
         for c in candidates:
             if c.is_final():
                 self.add_processed(c)
-            else:
-                self.candidates_list.append(c)
+            elif not self.is_pruned(c):
+                batch.append(c)
+        self.candidates_list.extend(batch)
+
+    def is_pruned(self, candidate):
+        '''
+        Candidates which offer upper_bound() are dropped once they cannot
+        reach best_score.  Ties are kept so that every best is found.
+        Bounds are not negative, so none is computed until best_score is
+        above 0.
+        '''
+        if not self.prune or self.best_score <= 0 or not hasattr(candidate, 'upper_bound'): return False
+        bound = candidate.upper_bound()
+        return bound is not None and bound < self.best_score
 
     def is_processed(self, candidate):
-        if not candidate._normalized_id in self._processed:
+        return self.is_processed_id(candidate._normalized_id, candidate.score())
+
+    def is_processed_id(self, normalized_id, score):
+        processed = self._processed.get(normalized_id)
+        if processed is None:
             return False
-        if self._processed[candidate._normalized_id] < candidate.score():
+        if processed < score:
             return False
         return True
 
     def add_processed(self, candidate):
         if candidate.is_final():
             if candidate.score() >= self.best_score:
+                self.best_score = candidate.score()
                 self.bests.append(candidate)
                 self.dumper.best(self.best_score, candidate)
-        if not candidate._normalized_id in self._processed:
-            self._processed[candidate._normalized_id] = candidate.score()
-        elif candidate.score() > self._processed[candidate._normalized_id]:
+        processed = self._processed.get(candidate._normalized_id)
+        if processed is None or candidate.score() > processed:
             self._processed[candidate._normalized_id] = candidate.score()
 
     def final_bests(self):
         best_score = max(c.score() for c in self.bests)
         bests = {c.normalized_id():c for c in self.bests if c.score() == best_score}
-        return bests.values()
+        return sorted(bests.values(), key=lambda c: c.dump())
+
+class DynamicProgrammingSearch(object):
+    '''
+    Exact search for candidates whose future score only depends on their
+    normalized state and the placements left, not on how they got there.
+    value(candidate) is the most score the remaining placements can add,
+    memoized by (normalized id, remaining()).
+
+    >>> from othello import OthelloCandidate, Board
+    >>> search = DynamicProgrammingSearch()
+    >>> search.search(OthelloCandidate(3, Board(width=3, height=3)))
+    1
+    >>> for b in search.final_bests():
+    ...    print b.board.dump(history=True)
+    ('...',
+     'BBB',
+     '...')(1, 0, 2)(1, 1, 1)(1, 2, 2)
+    ('B..',
+     '.B.',
+     '..B')(0, 0, 2)(1, 1, 1)(2, 2, 2)
+    ('B..',
+     'B..',
+     'B..')(0, 0, 2)(1, 0, 1)(2, 0, 2)
+    '''
+    def __init__(self):
+        self._values = {}
+        self.start = None
+
+    def key(self, candidate):
+        return (candidate._normalized_id, candidate.remaining())
+
+    def search(self, start):
+        self.start = start
+        value = self.value(start)
+        if value is None: return None
+        return start.score() + value
+
+    def value(self, candidate):
+        '''
+        None means no final candidate can be reached.
+        '''
+        key = self.key(candidate)
+        if key in self._values: return self._values[key]
+        if candidate.is_final():
+            self._values[key] = 0
+            return 0
+
+        best = [None]
+        base = candidate.score()
+        remaining = candidate.remaining() - 1
+        def known(normalized_id, score):
+            # children with a known value are used without being created
+            child_key = (normalized_id, remaining)
+            if not child_key in self._values: return False
+            value = self._values[child_key]
+            if value is not None and (best[0] is None or score - base + value > best[0]):
+                best[0] = score - base + value
+            return True
+
+        for child in candidate.next_states(known):
+            value = self.value(child)
+            if value is not None and (best[0] is None or child.score() - base + value > best[0]):
+                best[0] = child.score() - base + value
+        self._values[key] = best[0]
+        return best[0]
+
+    def final_bests(self):
+        '''
+        Follows the best placements from the start and returns one final
+        candidate per normalized id.
+        '''
+        finals = {}
+        visited = set()
+        def walk(candidate):
+            key = self.key(candidate)
+            if key in visited: return
+            visited.add(key)
+            if candidate.is_final():
+                finals[candidate._normalized_id] = candidate
+                return
+            target = self._values[key] + candidate.score()
+            for child in candidate.next_states():
+                value = self._values.get(self.key(child))
+                if value is not None and child.score() + value == target:
+                    walk(child)
+
+        if self.start is not None and self._values.get(self.key(self.start)) is not None:
+            walk(self.start)
+        return sorted(finals.values(), key=lambda c: c.dump())
+
+class LayeredSearch(object):
+    '''
+    Breadth-first search which expands one layer (candidates with the same
+    number of steps) at a time.  Children are kept in memory up to run_size
+    and written to sorted run files, which are merged into the next layer
+    keeping the best score for each normalized id.  A layer file is deleted
+    once it is expanded, so memory only holds one run at a time.
+
+    >>> from othello import OthelloCandidate, Board
+    >>> search = LayeredSearch(run_size=20)
+    >>> search.search(OthelloCandidate(3, Board(width=3, height=3)))
+    1
+    >>> for b in search.final_bests():
+    ...    print b.board.dump(history=True)
+    ('...',
+     'BBB',
+     '...')(1, 0, 2)(1, 1, 1)(1, 2, 2)
+    ('B..',
+     '.B.',
+     '..B')(0, 0, 2)(1, 1, 1)(2, 2, 2)
+    ('B..',
+     'B..',
+     'B..')(0, 0, 2)(1, 0, 1)(2, 0, 2)
+    >>> os.path.exists(search.directory)
+    False
+    '''
+    def __init__(self, dump=False, run_size=100000):
+        self.dump = dump
+        self.run_size = run_size
+        self.directory = None
+        self.bests = []
+        self.best_score = None
+        self._file_count = 0
+
+    def search(self, start):
+        self.directory = tempfile.mkdtemp(prefix='layers-')
+        try:
+            layer = self.write_run([start])
+            depth = 0
+            while True:
+                runs, finals = self.expand(layer)
+                os.remove(layer)
+                if finals:
+                    self.bests = finals
+                    break
+                if not runs: break
+                layer = self.merge(runs)
+                depth += 1
+                if self.dump:
+                    print 'layer %d: runs:%d, candidates:%d'%(depth, len(runs), self._merged_count)
+        finally:
+            shutil.rmtree(self.directory)
+        if self.bests:
+            self.best_score = max(c.score() for c in self.bests)
+        return self.best_score
+
+    def expand(self, layer):
+        runs = []
+        finals = []
+        children = {}
+        def is_processed(normalized_id, score):
+            return normalized_id in children and children[normalized_id].score() >= score
+
+        for candidate in self.read_run(layer):
+            if candidate.is_final():
+                finals.append(candidate)
+                continue
+            for child in candidate.next_states(is_processed):
+                children[child._normalized_id] = child
+                if len(children) >= self.run_size:
+                    runs.append(self.write_run(children.values()))
+                    children = {}
+        if children:
+            runs.append(self.write_run(children.values()))
+        return runs, finals
+
+    def merge(self, runs):
+        '''
+        Merges sorted runs into one layer, keeping the best score per id.
+        '''
+        records = heapq.merge(*[self.read_records(run) for run in runs])
+        path = self.new_path()
+        f = open(path, 'wb')
+        last_id = None
+        self._merged_count = 0
+        for normalized_id, negative_score, candidate in records:
+            if normalized_id == last_id: continue
+            last_id = normalized_id
+            pickle.dump((normalized_id, negative_score, candidate), f, pickle.HIGHEST_PROTOCOL)
+            self._merged_count += 1
+        f.close()
+        for run in runs: os.remove(run)
+        return path
+
+    def new_path(self):
+        self._file_count += 1
+        return os.path.join(self.directory, '%08d'%(self._file_count))
+
+    def write_run(self, candidates):
+        path = self.new_path()
+        f = open(path, 'wb')
+        for record in sorted((c._normalized_id, -c.score(), c) for c in candidates):
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        return path
+
+    def read_records(self, path):
+        f = open(path, 'rb')
+        try:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+        finally:
+            f.close()
+
+    def read_run(self, path):
+        for normalized_id, negative_score, candidate in self.read_records(path):
+            yield candidate
+
+    def final_bests(self):
+        bests = [c for c in self.bests if c.score() == self.best_score]
+        return sorted(bests, key=lambda c: c.dump())
 
 class Candidate(object):
     def normalized_id(self):
@@ -161,7 +404,33 @@ class Candidate(object):
     def score(self):
         raise StandardError('must be implemented')
 
-    def next_states(self):
+    def remaining(self):
+        '''
+        How many steps are left to a final candidate.  Used as part of the
+        memo key by DynamicProgrammingSearch.
+        '''
+        raise StandardError('must be implemented')
+
+    def priority(self):
+        '''
+        A number ordering candidates in the candidates list; the highest
+        priority is searched first.
+        '''
+        raise StandardError('must be implemented')
+
+    def upper_bound(self):
+        '''
+        Optional.  The best score any descendant can reach, which lets
+        Search prune the candidate.  None means there is no bound.  Bounds
+        must not be negative.
+        '''
+        return None
+
+    def next_states(self, is_processed=None):
+        '''
+        is_processed(normalized_id, score) lets the candidate skip children
+        which are already processed before creating them.
+        '''
         raise StandardError('must be implemented')
 
     def dump(self, **argv):
@@ -199,7 +468,7 @@ class SearchWithGenerator(Search):
 class ComparableCandidatesFlavor(object):
     @staticmethod
     def create_candidates_list():
-        return bigheap.BigHeap(max_threshold=30000, min_threshold=10000)
+        return bigheap.BigHeap(max_threshold=30000, min_threshold=10000, key=lambda c: c.priority())
 
     @staticmethod
     def create_processed():
@@ -212,27 +481,116 @@ class ComparableCandidatesFlavor(object):
     def create_bests():
         return []
 
+class BigHeapFlavor(ComparableCandidatesFlavor):
+    '''
+    Passes extra options to BigHeap, such as max_bytes to size the heap by
+    a memory budget, codec to spill candidates as fixed-size records
+    instead of pickles, prefetch and measure.
+    '''
+    def __init__(self, **options):
+        self.options = dict(max_threshold=30000, min_threshold=10000, key=lambda c: c.priority())
+        self.options.update(options)
+
+    def create_candidates_list(self):
+        return bigheap.BigHeap(**self.options)
+
+class CompactProcessedFlavor(BigHeapFlavor):
+    '''
+    BigHeapFlavor whose processed table is a ProcessedTable, about a fifth
+    of the memory of a dict but slower.  It only saves memory for ids
+    which fit its slots, such as hashed ids.
+    '''
+    def create_processed(self):
+        return processedtable.ProcessedTable()
+
+class SpillingProcessedFlavor(BigHeapFlavor):
+    '''
+    BigHeapFlavor whose processed table writes its entries to sorted
+    segments on disk beyond hot_limit, so that processed ids can grow
+    beyond memory like the spilled candidates.
+    '''
+    def __init__(self, hot_limit=1 << 20, **options):
+        BigHeapFlavor.__init__(self, **options)
+        self.hot_limit = hot_limit
+
+    def create_processed(self):
+        return processedtable.SpillingProcessedTable(self.hot_limit)
+
 import multiprocessing
+import Queue
 
 class CandidatesByQueue(object):
-    def __init__(self):
+    '''
+    A queue of candidates shared by worker processes, which also tells
+    when the workers are done.  pending counts candidates put and not yet
+    taken, and busy counts workers expanding a candidate: a worker is busy
+    from pop() until it next calls len(), pop() or release().  len() is 0
+    only when nothing is queued and no worker can add more.  pop() waits
+    while the queue is empty but others are busy, and raises IndexError
+    like list.pop() once no work is left.
+    '''
+    def __init__(self, timeout=0.05):
         self.queue = multiprocessing.Queue()
+        self.timeout = timeout
+        self._lock = multiprocessing.Lock()
+        self._pending = multiprocessing.Value('l', 0, lock=False)
+        self._busy = multiprocessing.Value('l', 0, lock=False)
+        # per process, as each worker has its own copy after fork
+        self._holding = False
+    def release(self):
+        if not self._holding: return
+        with self._lock:
+            self._busy.value -= 1
+        self._holding = False
     def pop(self):
-        return self.queue.get()
+        self.release()
+        while True:
+            try:
+                value = self.queue.get(True, self.timeout)
+            except Queue.Empty:
+                with self._lock:
+                    if self._pending.value == 0 and self._busy.value == 0:
+                        raise IndexError('pop from empty queue')
+                continue
+            # taken and busy in one step, so nobody sees neither
+            with self._lock:
+                self._pending.value -= 1
+                self._busy.value += 1
+            self._holding = True
+            return value
     def __len__(self):
-        return self.queue.qsize()
+        self.release()
+        with self._lock:
+            return self._pending.value + self._busy.value
     def append(self, value):
-        self.queue.put(value)
+        self.extend([value])
+    def extend(self, values):
+        values = list(values)
+        # counted before they are put, as a put reaches the queue later
+        with self._lock:
+            self._pending.value += len(values)
+        for value in values: self.queue.put(value)
 
 class MultiprocessingFlavor(object):
     '''
     Does not compare candidates; candidates are simply queued and shared.
-    Processed are shared by multiprocessing.Array.
+    Processed are shared by a Manager dict, behind a BloomFilter in shared
+    memory sized for filter_capacity ids at filter_error_rate, so that new
+    ids are answered without a call to the manager.  filter_capacity=0
+    leaves the filter out.
+
+    With shared_capacity, processed are kept in a SharedProcessedTable of
+    the capacity instead, which the workers read and write directly; the
+    Manager dict only takes what does not fit.
     '''
-    def __init__(self):
+    def __init__(self, filter_capacity=1 << 22, filter_error_rate=0.01, shared_capacity=0):
         self._candidates_list = CandidatesByQueue()
         self.manager = multiprocessing.Manager()
         self._processed = self.manager.dict()
+        if shared_capacity:
+            self._processed = processedtable.SharedProcessedTable(shared_capacity, overflow=self._processed)
+        elif filter_capacity:
+            self._processed = bloomfilter.FilteredProcessed(self._processed, bloomfilter.BloomFilter(filter_capacity, filter_error_rate))
         self._bests = self.manager.list()
 
     def create_candidates_list(self):
@@ -3,12 +3,13 @@
 import urllib2
 import socket
 
-from search_server import encode, decode
+from search_server import encode, decode_message
 
 class SearchClient(object):
     def __init__(self, url, batchsize):
         self.url = url
         self.batchsize = batchsize
+        self.codec = None   # learned from the server's messages
 
     def search(self):
         for candidates in self.candidate_lists():
@@ -29,7 +30,7 @@ class SearchClient(object):
         while True:
             try:
                 f = urllib2.urlopen(self.url + '/candidates?batch=%s'%(self.batchsize))
-                candidates = decode(f.read())
+                candidates, self.codec = decode_message(f.read())
                 f.close()
                 if not candidates: raise StopIteration
                 yield candidates
@@ -39,13 +40,13 @@ class SearchClient(object):
 
     def add_processed(self, processed):
         try:
-            f = urllib2.urlopen(self.url + '/processed', data=encode(processed))
+            f = urllib2.urlopen(self.url + '/processed', data=encode(processed, self.codec))
             f.close()
         except socket.error:
             pass
 
     def add_candiates(self, next_candidates):
-        data = encode(next_candidates)
+        data = encode(next_candidates, self.codec)
         try:
             f = urllib2.urlopen(self.url + '/candidates', data=data)
             f.close()
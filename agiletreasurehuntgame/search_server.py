@@ -4,21 +4,39 @@ import web
 from web.webapi import context
 import pickle
 import base64
+import struct
 import datetime
 import threading
 
 from search import Search
 
-def encode(obj):
+def encode(obj, codec=None):
     '''
+    Pickles obj.  With codec, obj must be a list of items which are sent as
+    packed records after a header holding the pickled codec.
+
     >>> encoded = encode(range(100))
     >>> decode(encoded) == range(100)
     True
     '''
-    return base64.encodestring(pickle.dumps(obj))
+    if not codec:
+        return 'P' + base64.encodestring(pickle.dumps(obj))
+    header = pickle.dumps(codec, pickle.HIGHEST_PROTOCOL)
+    return 'C' + struct.pack('<I', len(header)) + header + ''.join(codec.encode(item) for item in obj)
+
+def decode_message(s):
+    '''
+    Returns (decoded obj, codec of the message or None).
+    '''
+    if s[0] == 'P':
+        return pickle.loads(base64.decodestring(s[1:])), None
+    length, = struct.unpack_from('<I', s, 1)
+    start = 5 + length
+    codec = pickle.loads(s[5:start])
+    return [codec.decode(s, offset) for offset in xrange(start, len(s), codec.size)], codec
 
 def decode(s):
-    return pickle.loads(base64.decodestring(s))
+    return decode_message(s)[0]
 
 class SearchServer(object):
     urls = (
@@ -40,7 +58,7 @@ class SearchServer(object):
             SearchServer.search_lock.release()
             if not candidates:
                 print 'elapsed: %s'%(datetime.datetime.now() - SearchServer.first_req)
-            return encode(candidates)
+            return encode(candidates, SearchServer.codec)
 
         def POST(self):
             candidates = decode(context.env['wsgi.input'].read())
@@ -69,9 +87,10 @@ class SearchServer(object):
             cls.search_lock = threading.Semaphore()
 
     @classmethod
-    def run(cls, search):
+    def run(cls, search, codec=None):
         cls.init_semaphore(dummy=False)
         cls.search = search
+        cls.codec = codec
         cls.first_req = 0
         app = web.application(SearchServer.urls, cls.__dict__, autoreload=True)
         app.run()
@@ -0,0 +1,37 @@
+# coding: utf-8
+
+import unittest
+import multiprocessing
+import time
+from hamcrest import *
+
+from search import CandidatesByQueue
+
+
+def expand_slowly(queue, popped):
+    value = queue.pop()
+    popped.value = value
+    # the others see an empty queue while this worker is still busy
+    time.sleep(0.5)
+    queue.extend([value + 1, value + 2])
+    len(queue)
+
+
+class CandidatesByQueueTest(unittest.TestCase):
+    def test_busy_workers_keep_others_waiting(self):
+        queue = CandidatesByQueue()
+        queue.append(10)
+        popped = multiprocessing.Value('l', 0)
+        worker = multiprocessing.Process(target=expand_slowly, args=(queue, popped))
+        worker.start()
+        while not popped.value: time.sleep(0.01)
+
+        assert_that(len(queue), is_(1))
+        assert_that(sorted([queue.pop(), queue.pop()]), is_([11, 12]))
+        worker.join()
+        assert_that(len(queue), is_(0))
+        self.assertRaises(IndexError, queue.pop)
+
+
+if __name__=='__main__':
+    unittest.main()
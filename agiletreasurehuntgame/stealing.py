@@ -0,0 +1,222 @@
+# coding: utf-8
+
+import multiprocessing
+import Queue
+import random
+
+import processedtable
+from partitioned import Quiescence
+from search import Search, BigHeapFlavor
+
+
+class StealingFlavor(BigHeapFlavor):
+    '''
+    BigHeapFlavor whose processed table is shared by every worker, so that
+    a state expanded by one is skipped by the others.
+    '''
+    def __init__(self, processed, **options):
+        BigHeapFlavor.__init__(self, **options)
+        self.processed = processed
+
+    def create_processed(self):
+        return self.processed
+
+
+class StealingWorker(Search):
+    '''
+    A Search over its own BigHeap, best first.  A worker which runs out of
+    candidates becomes a thief: it picks victims in random order and posts
+    a steal request in the victim's slot of requests.  Heaps are private
+    to their processes, so a victim answers the requests in its slot every
+    poll_interval expansions, with a batch of its best candidates up to
+    half of its heap, or with an empty batch when it has nothing to spare
+    or is idle itself.  The thief then tries the next victim.
+
+    Inboxes carry (sender, batch) pairs: steal replies, and the start
+    batches, which come from no worker.
+    '''
+    def __init__(self, index, inboxes, requests, quiescence, shared_best, batch_size, poll_interval, flavor):
+        Search.__init__(self, flavor=flavor)
+        self.index = index
+        self.inboxes = inboxes
+        self.requests = requests
+        self.quiescence = quiescence
+        self.shared_best = shared_best
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.victim = None      # whose reply this worker waits for
+        self.expanded = 0
+        self.steals = 0
+        self.robbed = 0
+
+    def add_processed(self, candidate):
+        Search.add_processed(self, candidate)
+        if self.best_score > self.shared_best.value:
+            with self.shared_best.get_lock():
+                if self.best_score > self.shared_best.value:
+                    self.shared_best.value = self.best_score
+
+    def receive(self, block, was_idle=False):
+        '''
+        Takes one message from the inbox.  Returns whether it held work.
+        '''
+        try:
+            sender, batch = self.inboxes[self.index].get(block, 0.05)
+        except Queue.Empty:
+            return False
+        if sender == self.victim: self.victim = None
+        if not batch: return False
+        self.quiescence.received(was_idle)
+        if sender is not None: self.steals += 1
+        self.best_score = max(self.best_score, self.shared_best.value)
+        Search.add_candiates(self, batch)
+        return True
+
+    def answer(self):
+        '''
+        Answers the steal request in this worker's slot, if any.
+        '''
+        if not self.requests[self.index]: return
+        with self.requests.get_lock():
+            thief, self.requests[self.index] = self.requests[self.index] - 1, 0
+        size = min(self.batch_size, len(self.candidates_list) // 2)
+        batch = [self.candidates_list.pop() for _ in range(size)]
+        if batch:
+            # counted before it is put, so that nobody sees all idle with it in flight
+            self.quiescence.sent()
+            self.robbed += 1
+        self.inboxes[thief].put((self.index, batch))
+
+    def request(self, victim):
+        '''
+        Posts a steal request to victim unless another thief has.
+        '''
+        with self.requests.get_lock():
+            if self.requests[victim]: return False
+            self.requests[victim] = self.index + 1
+        self.victim = victim
+        return True
+
+    def steal(self):
+        '''
+        Waits for work as a thief until some comes, or until the search is
+        done.  Returns whether work came.
+        '''
+        self.quiescence.idle()
+        victims = []
+        while not self.quiescence.done.is_set():
+            self.answer()
+            if self.victim is None and not victims:
+                # every victim has been tried; wait a while before the next round
+                victims = [i for i in range(len(self.inboxes)) if i != self.index]
+                random.shuffle(victims)
+            else:
+                while self.victim is None and victims and not self.request(victims.pop()): pass
+            if self.receive(block=True, was_idle=True): return True
+        return False
+
+    def run(self):
+        self.start_dumper()
+        while True:
+            while self.receive(block=False): pass
+            candidate = self.pop_candidate()
+            if candidate:
+                self.process_candidate(candidate)
+                self.expanded += 1
+                if self.expanded % self.poll_interval == 0: self.answer()
+                continue
+            if not self.steal(): return
+
+    def pop_candidate(self):
+        while len(self.candidates_list):
+            candidate = self.candidates_list.pop()
+            if not self.is_processed(candidate) and not self.is_pruned(candidate): return candidate
+        return None
+
+
+def run_worker(index, inboxes, requests, quiescence, shared_best, batch_size, poll_interval, flavor, results):
+    worker = StealingWorker(index, inboxes, requests, quiescence, shared_best, batch_size, poll_interval, flavor)
+    try:
+        worker.run()
+    except:
+        # the others would wait for this worker forever
+        quiescence.done.set()
+        raise
+    finally:
+        bests = [b for b in worker.bests if b.score() >= worker.best_score]
+        results.put((index, bests, worker.expanded, worker.steals, worker.robbed))
+
+
+class StealingSearch(object):
+    '''
+    Searches with one process per worker, each keeping its own frontier
+    in best-first order.  Idle workers steal batches from busy ones, and
+    the search ends once every worker is idle with no batch in flight.
+    Processed ids are shared in a SharedProcessedTable of capacity.
+
+    >>> from othello import OthelloCandidate, Board
+    >>> search = StealingSearch(workers=2, batch_size=4)
+    >>> search.search(OthelloCandidate(3, Board(width=3, height=3)))
+    1
+    >>> for b in search.final_bests():
+    ...    print b.board.dump()
+    ('...',
+     'BBB',
+     '...')
+    ('B..',
+     '.B.',
+     '..B')
+    ('B..',
+     'B..',
+     'B..')
+    '''
+    def __init__(self, workers=2, batch_size=64, poll_interval=64, capacity=1 << 20):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.capacity = capacity
+        self.bests = []
+        self.best_score = None
+        self.processed = 0
+        self.worker_stats = []
+
+    def search(self, start):
+        manager = multiprocessing.Manager()
+        processed = processedtable.SharedProcessedTable(self.capacity, overflow=manager.dict())
+        flavor = StealingFlavor(processed)
+        inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+        # thief index + 1 in the slot of each victim, 0 when none
+        requests = multiprocessing.Array('i', self.workers)
+        quiescence = Quiescence(self.workers)
+        shared_best = multiprocessing.Value('l', 0)
+        results = multiprocessing.Queue()
+
+        batches = [[] for _ in range(self.workers)]
+        for i, c in enumerate(start.next_states()):
+            batches[i % self.workers].append(c)
+        for index, batch in enumerate(batches):
+            if not batch: continue
+            quiescence.sent()
+            inboxes[index].put((None, batch))
+
+        processes = [multiprocessing.Process(target=run_worker, args=(i, inboxes, requests, quiescence, shared_best, self.batch_size, self.poll_interval, flavor, results))
+                     for i in range(self.workers)]
+        [p.start() for p in processes]
+        # results are taken before join, as a process does not end until its queue is flushed
+        collected = sorted(results.get() for _ in processes)
+        [p.join() for p in processes]
+        self.processed = len(processed)
+        manager.shutdown()
+
+        self.worker_stats = [(expanded, steals, robbed) for _, _, expanded, steals, robbed in collected]
+        bests = [b for _, worker_bests, _, _, _ in collected for b in worker_bests]
+        if bests:
+            self.best_score = max(b.score() for b in bests)
+        unique = {}
+        for b in bests:
+            if b.score() == self.best_score: unique[b._normalized_id] = b
+        self.bests = unique.values()
+        return self.best_score
+
+    def final_bests(self):
+        return sorted(self.bests, key=lambda c: c.dump())
@@ -0,0 +1,26 @@
+# coding: utf-8
+
+import unittest
+from hamcrest import *
+
+from othello import Board, OthelloCandidate
+from othello_test import assert_same_bests_as_search
+from stealing import StealingSearch
+
+
+class StealingSearchTest(unittest.TestCase):
+    def test_same_bests_as_search(self):
+        assert_same_bests_as_search(lambda start: StealingSearch(workers=3, batch_size=8, poll_interval=4))
+
+    def test_workers_without_start_candidates_steal(self):
+        # 4x4 has 6 distinct first moves, so two of the workers start empty
+        stealing = StealingSearch(workers=8, batch_size=4, poll_interval=1)
+        stealing.search(OthelloCandidate(4, Board(width=4, height=4)))
+        steals = sum(steals for _, steals, _ in stealing.worker_stats)
+        robbed = sum(robbed for _, _, robbed in stealing.worker_stats)
+        assert_that(steals, greater_than(0))
+        assert_that(steals, is_(robbed))
+
+
+if __name__=='__main__':
+    unittest.main()